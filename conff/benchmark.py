@@ -0,0 +1,299 @@
+"""
+Benchmarks for conff, run with:
+
+    python -m conff.benchmark yaml --scale 200
+    python -m conff.benchmark config --size 1000 --output results.json
+    python -m conff.benchmark config --size 1000 --compare results.json
+    python -m conff.benchmark import
+"""
+import argparse
+import copy
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+from conff import utils
+from conff.parser import Parser
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def scale_yaml(text: str, scale: int):
+    """
+    Repeat YAML mapping document under numbered keys to get a bigger document
+    """
+    lines = ['  ' + line if line.strip() else line for line in text.splitlines()]
+    body = '\n'.join(lines)
+    return '\n'.join('copy_{}:\n{}'.format(i, body) for i in range(scale))
+
+
+def get_fixtures():
+    """
+    Single document YAML mapping in the data directory, malformed ones are skipped
+    """
+    for fs_path in sorted(glob.glob(os.path.join(DATA_PATH, '*.yml'))):
+        name = os.path.basename(fs_path)
+        if name.startswith('malformed'):
+            continue
+        with open(fs_path) as stream:
+            text = stream.read()
+        try:
+            data = utils.yaml_safe_load(text, loader_cls=utils.get_yaml_loader(pure=True))
+        except Exception:
+            continue
+        if isinstance(data, dict):
+            yield name, text
+
+
+def timeit(fn, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_yaml(scale: int = 200, repeat: int = 3):
+    """
+    Compare the pure Python and libyaml ordered loaders on the scaled up fixtures
+
+    :return: List of dict per fixture with timing of both loaders in seconds
+    """
+    results = []
+    for name, text in get_fixtures():
+        text = scale_yaml(text, scale)
+        py_loader, c_loader = utils.get_yaml_loader(pure=True), utils.get_yaml_loader()
+        py_time, py_data = timeit(lambda: utils.yaml_safe_load(io.StringIO(text), py_loader), repeat)
+        c_time, c_data = timeit(lambda: utils.yaml_safe_load(io.StringIO(text), c_loader), repeat)
+        if py_data != c_data or list(py_data) != list(c_data):
+            raise AssertionError('Loaders result mismatch on {}'.format(name))
+        results.append({'name': name, 'bytes': len(text), 'python': py_time, 'default': c_time,
+                        'speedup': py_time / c_time if c_time else None})
+    return results
+
+
+# key used by the encrypted leaves of the synthetic configs
+EKEY = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+
+
+def gen_nested(size: int):
+    """
+    Binary tree of dicts, as deep as needed for size leaves, each leaf refers to the first one
+    """
+    depth = max(size.bit_length() - 1, 1)
+
+    def node(level, index):
+        if level == depth:
+            return 'R.nested' + '.n_0' * depth + ' + {}'.format(index) if index else 1
+        return {'n_{}'.format(i): node(level + 1, index * 2 + i) for i in range(2)}
+
+    return {'nested': node(0, 0)}, {}, 2 ** depth
+
+
+def gen_foreach(size: int):
+    template = {'"item_%i" % loop.index': {'value': 'loop.value * 2', 'length': 'loop.length'}}
+    data = {'wide': {'F.foreach': {'values': 'F.arange(0, {}, 1)'.format(size - 1), 'template': template}}}
+    return data, {}, size
+
+
+def gen_include(size: int):
+    files = {'inc_{}.yml'.format(i): {'value': i, 'name': "'inc_' + F.str({})".format(i)} for i in range(size)}
+    data = {'inc_{}'.format(i): "F.inc('inc_{}.yml')".format(i) for i in range(size)}
+    return data, files, size
+
+
+def gen_extend(size: int):
+    base = {'key_{}'.format(i): {'value': i, 'items': [i, i + 1]} for i in range(50)}
+    data = {'base': base}
+    data.update(('ext_{}'.format(i), {'F.extend': 'R.base', 'key_0': i}) for i in range(size))
+    return data, {}, size
+
+
+def gen_expr(size: int):
+    data = {'v_0': 1}
+    data.update(('v_{}'.format(i), "R.v_{} + 1 if R.v_0 else 'x' * 2".format(i - 1)) for i in range(1, size))
+    return data, {}, size
+
+
+def gen_encrypt(size: int):
+    p = Parser(params={'ekey': EKEY})
+    tokens = p.encrypt_many(['secret_{}'.format(i) for i in range(size)])
+    return {'secret_{}'.format(i): "F.decrypt('{}')".format(t) for i, t in enumerate(tokens)}, {}, size
+
+
+# synthetic config generators by name, each returns root data, included files and number of directives
+GENERATORS = {
+    'nested': gen_nested,
+    'foreach': gen_foreach,
+    'include': gen_include,
+    'extend': gen_extend,
+    'expr': gen_expr,
+    'encrypt': gen_encrypt,
+}
+
+
+def write_config(fs_root: str, name: str, size: int):
+    """
+    Write the synthetic config and its included files as YAML
+
+    :return: Tuple of path of the root file and number of directives
+    """
+    data, files, ops = GENERATORS[name](size)
+    files = dict(files, **{'{}.yml'.format(name): data})
+    for fs_path, value in files.items():
+        with open(os.path.join(fs_root, fs_path), 'w') as stream:
+            yaml.safe_dump(value, stream, default_flow_style=False, sort_keys=False)
+    return os.path.join(fs_root, '{}.yml'.format(name)), ops
+
+
+def bench_config(size: int = 1000, repeat: int = 3, names: list = None):
+    """
+    Time load and parse of the synthetic configs. parse only covers the
+    evaluation, the raw data is read upfront.
+
+    :return: List of dict per config with seconds, leaves per second of load,
+    peak memory in bytes of one load and seconds per directive
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as fs_root:
+        for name in names or list(GENERATORS):
+            fs_path, ops = write_config(fs_root, name, size)
+            params = {'ekey': EKEY}
+            load_time, data = timeit(lambda: Parser(params=params).load(fs_path), repeat)
+            raw = Parser().read_file(fs_path)
+
+            def parse():
+                root = copy.deepcopy(raw)
+                p = Parser(names={'R': root}, params=dict(params, fs_root=fs_root))
+                return p.parse(root), p.errors
+
+            parse_time, (_, errors) = timeit(parse, repeat)
+            tracemalloc.start()
+            Parser(params=params).load(fs_path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            leaves = utils.count_leaves(data)
+            results.append({'name': name, 'size': size, 'leaves': leaves, 'errors': len(errors),
+                            'load': load_time, 'parse': parse_time, 'leaves_per_sec': leaves / load_time,
+                            'peak_memory': peak, 'per_op': parse_time / ops})
+    return results
+
+
+# heavy dependencies only imported once a feature needs them, not by import conff and a plain load
+LAZY_MODULES = ('asyncio', 'concurrent.futures', 'conff.cache', 'cryptography', 'hashlib', 'jinja2')
+
+# run in a fresh interpreter, modules imported before start are not counted
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import conff
+imported = time.perf_counter()
+conff.load({fs_path!r})
+loaded = time.perf_counter()
+modules = [m for m in {modules!r} if m in sys.modules]
+import json
+print(json.dumps({{'import': imported - start, 'load': loaded - imported, 'modules': modules}}))
+'''
+
+
+def bench_import(size: int = 100, repeat: int = 3, fs_package_root: str = None):
+    """
+    Time import conff and the first load of a plain YAML config in a fresh
+    interpreter, and list the lazy modules it imported anyway
+
+    :param fs_package_root: Directory of another conff checkout to time instead, e.g. a baseline
+    :return: dict with median seconds of import and load and the imported lazy modules
+    """
+    fs_package_root = fs_package_root or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([fs_package_root] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    runs = []
+    with tempfile.TemporaryDirectory() as fs_root:
+        fs_path, _ = write_config(fs_root, 'nested', size)
+        script = IMPORT_SCRIPT.format(fs_path=fs_path, modules=LAZY_MODULES)
+        # the first run writes the bytecode, it is not timed
+        for _ in range(repeat + 1):
+            output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE,
+                                    universal_newlines=True, env=env, cwd=fs_root).stdout
+            runs.append(json.loads(output.splitlines()[-1]))
+    runs = runs[1:]
+    # import time is noisy, median is steadier than the best run
+    return {'import': statistics.median(r['import'] for r in runs),
+            'load': statistics.median(r['load'] for r in runs), 'modules': runs[-1]['modules']}
+
+
+def compare(results: list, baseline: list, threshold: float = 0.1):
+    """
+    Compare load time with the results saved by a previous run
+
+    :return: List of (name, baseline seconds, seconds, ratio, regressed)
+    """
+    baseline = {(r['name'], r['size']): r for r in baseline}
+    result = []
+    for r in results:
+        b = baseline.get((r['name'], r['size']))
+        if b is None:
+            continue
+        ratio = r['load'] / b['load']
+        result.append((r['name'], b['load'], r['load'], ratio, ratio > 1 + threshold))
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='conff benchmarks')
+    parser.add_argument('suite', choices=['yaml', 'config', 'import'])
+    parser.add_argument('--scale', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--size', type=int, default=1000, help='number of directives of each config')
+    parser.add_argument('--configs', nargs='*', choices=list(GENERATORS), help='configs to run, default all')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slow down ratio reported as regression')
+    parser.add_argument('--against', help='directory of another conff checkout to time import against')
+    args = parser.parse_args(args)
+    if args.suite == 'yaml':
+        print('default loader: {}'.format(utils.get_yaml_loader().__bases__[0].__name__))
+        print('{:<24}{:>12}{:>12}{:>12}{:>10}'.format('fixture', 'bytes', 'python(s)', 'default(s)', 'speedup'))
+        for r in bench_yaml(scale=args.scale, repeat=args.repeat):
+            print('{name:<24}{bytes:>12}{python:>12.4f}{default:>12.4f}{speedup:>9.1f}x'.format(**r))
+    elif args.suite == 'import':
+        print('{:<10}{:>10}{:>10}{:>10}  {}'.format(
+            'tree', 'import(s)', 'load(s)', 'total(s)', 'lazy modules imported'))
+        trees = [('current', None)] + ([('against', args.against)] if args.against else [])
+        for tree, fs_package_root in trees:
+            r = bench_import(size=args.size, repeat=args.repeat, fs_package_root=fs_package_root)
+            print('{:<10}{:>10.4f}{:>10.4f}{:>10.4f}  {}'.format(
+                tree, r['import'], r['load'], r['import'] + r['load'], ', '.join(r['modules']) or '-'))
+    elif args.suite == 'config':
+        results = bench_config(size=args.size, repeat=args.repeat, names=args.configs)
+        print('{:<10}{:>8}{:>10}{:>10}{:>14}{:>12}{:>12}{:>8}'.format(
+            'config', 'leaves', 'load(s)', 'parse(s)', 'leaves/sec', 'peak(KiB)', 'op(us)', 'errors'))
+        for r in results:
+            print('{name:<10}{leaves:>8}{load:>10.4f}{parse:>10.4f}{leaves_per_sec:>14.0f}{peak:>12.0f}{op:>12.2f}'
+                  '{errors:>8}'.format(peak=r['peak_memory'] / 1024, op=r['per_op'] * 1e6, **r))
+        if args.compare:
+            with open(args.compare) as stream:
+                baseline = json.load(stream)['results']
+            for name, before, after, ratio, regressed in compare(results, baseline, threshold=args.threshold):
+                print('{:<10}{:>10.4f}{:>10.4f}{:>8.2f}x{}'.format(
+                    name, before, after, ratio, '  REGRESSION' if regressed else ''))
+        if args.output:
+            with open(args.output, 'w') as stream:
+                json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                           'time': time.time(), 'results': results}, stream, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+from conff.utils import get_cipher
+
+logger = logging.getLogger('conff')
+
+
+def file_digest(fs_file_path: str):
+    """
+    Fingerprint of the file content, None if the file is no longer exist
+    """
+    try:
+        with open(fs_file_path, 'rb') as stream:
+            return hashlib.sha1(stream.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def fn_table(fns: dict, prefix: str = ''):
+    """
+    Name and qualified name of every function, nested dict of functions included
+    """
+    for k, fn in fns.items():
+        name = '{}{}'.format(prefix, k)
+        if isinstance(fn, dict):
+            yield from fn_table(fn, name + '.')
+        else:
+            yield name, '{}.{}'.format(getattr(fn, '__module__', None), getattr(fn, '__qualname__', repr(fn)))
+
+
+class LoadCache(object):
+    """
+    Persist fully parsed config on disk. An entry stays valid as long as the
+    content of every file used to build it (root file and every F.inc) is
+    unchanged. Entries are encrypted when ekey is given, so decrypted values
+    never stored as plain text.
+    """
+
+    def __init__(self, cache_dir: str, ekey=None):
+        self.cache_dir = cache_dir
+        self.ekey = ekey
+
+    def key(self, fs_file_path: str, names: dict = None, params: dict = None, fns: dict = None):
+        """
+        :param fns: Functions of the expressions, told apart by their qualified name
+        """
+        # R and loop are per load values, fs_* are covered by the file path
+        names = {k: v for k, v in (names or {}).items() if k not in ('R', 'loop')}
+        params = {k: v for k, v in (params or {}).items() if not k.startswith('fs_')}
+        raw = repr((os.path.abspath(fs_file_path), sorted(names.items()), sorted(params.items()),
+                    sorted(fn_table(fns or {}))))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get_path(self, key: str):
+        return os.path.join(self.cache_dir, '{}.cache'.format(key))
+
+    def check(self):
+        """
+        Refuse a cache directory which other users could write, entries are
+        unpickled so anyone who could write one runs code in the loading process
+        """
+        try:
+            stat = os.stat(self.cache_dir)
+        except FileNotFoundError:
+            return
+        if (hasattr(os, 'getuid') and stat.st_uid != os.getuid()) or stat.st_mode & 0o022:
+            raise ValueError('Cache directory must be owned by the current user and writable only by it: {}'.format(
+                self.cache_dir))
+
+    def get(self, key: str):
+        """
+        :return: Cached entry with "data" and "files" keys, None if missing or stale
+        """
+        self.check()
+        try:
+            with open(self.get_path(key), 'rb') as stream:
+                entry = pickle.loads(self.decode(stream.read()))
+        except Exception as ex:
+            if not isinstance(ex, FileNotFoundError):
+                logger.warning('Unable to read cache {}: {}'.format(key, ex))
+            return None
+        for fs_file_path, digest in entry['files']:
+            if file_digest(fs_file_path) != digest:
+                return None
+        return entry
+
+    def set(self, key: str, files: list, data):
+        """
+        Write the entry atomically, so many processes could share the cache directory
+        """
+        files = [(fs_file_path, file_digest(fs_file_path)) for fs_file_path in files]
+        try:
+            raw = self.encode(pickle.dumps({'files': files, 'data': data}, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as ex:
+            logger.warning('Unable to write cache {}: {}'.format(key, ex))
+            return
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        self.check()
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(raw)
+        os.replace(tmp_path, self.get_path(key))
+
+    def encode(self, raw: bytes):
+        if not self.ekey:
+            return raw
+        return get_cipher(self.ekey).encrypt(raw)
+
+    def decode(self, raw: bytes):
+        if not self.ekey:
+            return raw
+        return get_cipher(self.ekey).decrypt(raw)
@@ -0,0 +1,137 @@
+import threading
+from collections.abc import Sequence
+
+# severity of the collected errors, in increasing order
+SEVERITIES = ('info', 'warning', 'error')
+SEVERITY_LEVELS = {k: i for i, k in enumerate(SEVERITIES)}
+
+
+class Diagnostic(object):
+    """
+    Error of a single expression: severity, error class, message, expression,
+    file and config path where it happened and the exception itself
+    """
+    __slots__ = ('severity', 'category', 'message', 'expression', 'file', 'path', 'error')
+
+    def __init__(self, error, severity: str = 'warning', expression: str = None, file: str = None,
+                 path: tuple = ()):
+        self.severity = severity
+        self.category = type(error).__name__
+        self.message = str(error)
+        self.expression = expression
+        self.file = file
+        self.path = tuple(path)
+        self.error = error
+
+    @property
+    def location(self):
+        path = '.'.join(str(k) for k in self.path)
+        return '{}:{}'.format(self.file, path) if self.file else path
+
+    def todict(self):
+        return {'severity': self.severity, 'category': self.category, 'message': self.message,
+                'expression': self.expression, 'file': self.file, 'path': self.path}
+
+    def __repr__(self):
+        return '{}({} {} at {}: {})'.format(type(self).__name__, self.severity, self.category, self.location or '?',
+                                            self.message)
+
+
+class Diagnostics(Sequence):
+    """
+    Bounded collector of the errors of a parser. It is a sequence of the
+    exceptions so it could be used as the former errors list, records holds
+    their Diagnostic. Every error is counted by error class and severity, but
+    only maxsize of them are stored, one of every sample per error class and
+    only from the given severity up.
+    """
+
+    def __init__(self, maxsize: int = 1000, sample: int = 1, severity: str = 'info'):
+        self.maxsize = maxsize
+        self.sample = max(int(sample), 1)
+        self.level = SEVERITY_LEVELS[severity]
+        self.records = []
+        self.counts = {}
+        self.severities = dict.fromkeys(SEVERITIES, 0)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [r.error for r in self.records[i]]
+        return self.records[i].error
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, Diagnostics)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.records)
+
+    def add(self, error, severity: str = 'warning', expression: str = None, file: str = None, path: tuple = ()):
+        """
+        Count the error and store it unless it is filtered out or the collector is full
+
+        :return: The stored Diagnostic, None if it is not stored
+        """
+        category = type(error).__name__
+        with self._lock:
+            count = self.counts[category] = self.counts.get(category, 0) + 1
+            self.severities[severity] += 1
+            if SEVERITY_LEVELS[severity] < self.level or (count - 1) % self.sample or len(self.records) >= self.maxsize:
+                self.dropped += 1
+                return None
+            record = Diagnostic(error, severity=severity, expression=expression, file=file, path=path)
+            self.records.append(record)
+        return record
+
+    def append(self, error):
+        self.add(error)
+
+    def extend(self, errors):
+        """
+        Merge errors of another collector (with its counters), Diagnostic records or plain exceptions
+        """
+        if not isinstance(errors, Diagnostics):
+            for error in errors:
+                if isinstance(error, Diagnostic):
+                    self.add_record(error)
+                else:
+                    self.add(error)
+            return
+        with self._lock:
+            for category, count in errors.counts.items():
+                self.counts[category] = self.counts.get(category, 0) + count
+            for severity, count in errors.severities.items():
+                self.severities[severity] += count
+            self.dropped += errors.dropped
+            room = max(self.maxsize - len(self.records), 0)
+            self.records.extend(errors.records[:room])
+            self.dropped += max(len(errors.records) - room, 0)
+
+    def add_record(self, record: Diagnostic):
+        with self._lock:
+            self.counts[record.category] = self.counts.get(record.category, 0) + 1
+            self.severities[record.severity] += 1
+            if len(self.records) >= self.maxsize:
+                self.dropped += 1
+            else:
+                self.records.append(record)
+
+    def filter(self, severity: str = None, category: str = None):
+        return [r for r in self.records if (severity is None or r.severity == severity) and
+                (category is None or r.category == category)]
+
+    def summary(self):
+        return {'total': sum(self.counts.values()), 'stored': len(self.records), 'dropped': self.dropped,
+                'categories': dict(self.counts), 'severities': dict(self.severities)}
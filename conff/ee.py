@@ -20,23 +20,16 @@ def load(fs_path: str, fs_root: str = '', params: dict = None, errors: list = No
 
 
 def encrypt(names: dict):
-    def fn_encrypt(data):
-        from conff import Parser
-        p = Parser(names=names, params=names.get('R', {}).get('_', {}))
-        result = p.fn_encrypt(data)
-        return result
-
-    return fn_encrypt
+    # the parser is built once, the returned function could be called for many values
+    from conff import Parser
+    p = Parser(names=names, params=names.get('R', {}).get('_', {}))
+    return p.fn_encrypt
 
 
 def decrypt(names: dict):
-    def fn_decrypt(data):
-        from conff import Parser
-        p = Parser(names=names, params=names.get('R', {}).get('_', {}))
-        result = p.fn_decrypt(data)
-        return result
-
-    return fn_decrypt
+    from conff import Parser
+    p = Parser(names=names, params=names.get('R', {}).get('_', {}))
+    return p.fn_decrypt
 
 
 def generate_key(names: dict):
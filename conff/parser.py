@@ -1,23 +1,70 @@
-import json
+import ast
 import logging
 import os
 import collections
+import contextlib
 import copy
+import functools
+import keyword
+import math
+import re
 import sys
+import threading
+import time
+import types
 
 import simpleeval
 import warnings
-from jinja2 import Template
+from collections.abc import Mapping, Sequence
 from simpleeval import EvalWithCompoundTypes
-from cryptography.fernet import Fernet
 from conff import utils
-from conff.utils import Munch2, update_recursive, yaml_safe_load, filter_value, odict
+from conff.diagnostics import Diagnostics
+from conff.utils import (Munch2, LazyMunch, LinearRange, IMMUTABLE_TYPES, copy_tree, update_recursive, yaml_safe_load,
+                         yaml_safe_load_all, filter_value, odict)
+
+# characters which never start a valid expression
+LITERAL_START_CHARS = frozenset('/\\$?!@#%&|^<>=,;:`*)]}')
+# outside of quoted strings, these could not be part of valid expression e.g. URL, shell variable
+LITERAL_CHARS_RE = re.compile(r'[$?`]|!(?!=)|://')
+# plain, dotted or dashed names such as hostname or region, it is only an expression if the first name is known
+NAME_CHAIN_RE = re.compile(r'^[A-Za-z_]\w*([.-]\w+)*$')
+# AST node class names of literal values
+CONSTANT_NODES = ('Constant', 'Str', 'Num', 'Bytes', 'NameConstant')
+# kinds of the F.foreach plan nodes, see Parser.compile_foreach
+PLAN_STATIC, PLAN_EXPR, PLAN_PARSE, PLAN_DICT, PLAN_LIST, PLAN_PROCESS = range(6)
 
 
 class Parser:
+    # parsed expressions, shared by every parser including the F.inc sub-parsers
+    expr_cache = utils.LRUCache(maxsize=4096)
+    # compiled F.template by template_mode and source, shared by every parser
+    template_cache = utils.LRUCache(maxsize=256)
+    # jinja2 environment by template_mode, built on first F.template, see get_template_env
+    template_envs = {}
+    # F.linspace and F.arange return LinearRange regardless of range_output, set while F.foreach values are processed
+    _lazy_range = False
     # default params
     default_params = {
         'etype': 'fernet',
+        # how string is detected as expression, "auto" guess by the syntax, "explicit" requires expr_prefix
+        'expr_mode': 'auto',
+        'expr_prefix': '=',
+        # order to evaluate values, "document" top to bottom, "dependency" values referred by R are evaluated first
+        'eval_order': 'document',
+        # F.template output, "yaml" parses the rendered text, "native" keeps python value rendered by the template
+        'template_mode': 'yaml',
+        # F.linspace and F.arange output, "list", "lazy" LinearRange or "numpy" array, F.foreach values are always lazy
+        'range_output': 'list',
+        # directory to persist fully parsed config loaded from file
+        'cache_dir': None,
+        # F.foreach items per chunk, chunks are instantiated in parallel by the workers of the parser,
+        # 0 instantiates the items in order
+        'foreach_chunk': 0,
+        # return load and parse result as immutable utils.FrozenMunch with path index, see utils.freeze
+        'freeze': False,
+        # Parser.errors keeps at most maxsize errors, one of every sample per error class, from severity
+        # ("info", "warning" or "error") up, the rest is only counted
+        'diagnostics': {'maxsize': 1000, 'sample': 1, 'severity': 'info'},
         # list of simpleeval library parameters
         'simpleeval': {
             # by default operators = simpleeval.DEFAULT_OPERATORS,
@@ -30,18 +77,52 @@ class Parser:
         }
     }
 
-    def __init__(self, names=None, fns=None, params=None):
+    def __init__(self, names=None, fns=None, params=None, workers: int = None, executor: str = 'thread',
+                 profiler=None):
         """
         :param params: A dictionary containing some parameters that will modify
         how the builtin functions run. For example, the type of encryption to
         use and the encrpyption key to use or simpleeval library parameters
+        :param workers: Number of workers to load independent F.inc files in
+        parallel, disabled by default
+        :param executor: Pool used by the workers, either "thread" or "process"
+        :param profiler: conff.profiler.Profiler to record time spent per config
+        path and per directive, disabled by default
         """
-        self.errors = []
+        self.workers = workers
+        self.executor = executor
+        # every file read by the last load, including the F.inc ones
+        self.files = []
+        # dependencies recorded by load(..., track=True) for reload
+        self.tracked = None
+        # per load state shared with F.inc sub parsers: included results and the chain of files being loaded
+        self.includes = None
+        self.include_stack = []
+        # per load F.decrypt tokens decrypted upfront by the workers
+        self.secrets = None
+        # raw data of the files read upfront by aload, by absolute path
+        self.preloaded = None
+        self._sub_parser = None
+        # F.template calls and time spent in seconds
+        self.template_stats = {'count': 0, 'render': 0.0, 'parse': 0.0}
+        # parser of the context, None for the configured parser, see context()
+        self.parent = None
+        self._lock = threading.RLock()
         self.logger = self.prepare_logger()
         self.params = self.prepare_params(params=params)
-        self.fns = self.prepare_functions(fns=fns)
+        # the collector is built on the first error
+        self._errors = None
+        # F functions and the evaluator are only built once an expression needs them, see fns and evaluator
+        self._fns = None
+        self._user_fns = fns
         self.names = self.prepare_names(names=names)
-        self._evaluator = self.prepare_evaluator()
+        self._evaluator = None
+        self._evaluator_cls = get_evaluator_cls(self.params.get('simpleeval', {}).get('options', {}))
+        # evaluators given back by the finished parse contexts, reused by the next ones
+        self._evaluators = []
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
 
     def prepare_logger(self):
         logger = logging.getLogger('conff')
@@ -58,17 +139,65 @@ class Parser:
         :return: Prepared parameters
         """
         # ensure not to update mutable params
-        params = copy.deepcopy(params or {})
-        # inject with default params with exception for simpleeval.operators
-        params = utils.update_recursive(params, self.default_params)
+        params = copy.deepcopy(params) if params else {}
+        # inject params into the defaults, so user could override any of them, only the overridden defaults are copied
+        params = utils.update_shared(self.get_default_params(), params)
+        return params
+
+    @classmethod
+    def get_default_params(cls):
+        """
+        default_params with the nested values frozen, so every parser shares them
+        """
+        params = cls.__dict__.get('_default_params')
+        if params is None:
+            params = {k: utils.freeze(v, index=False) for k, v in cls.default_params.items()}
+            cls._default_params = params
         return params
 
+    def prepare_errors(self):
+        """
+        Collector of the errors, bounded by the diagnostics param
+        """
+        return Diagnostics(**self.params.get('diagnostics', {}))
+
     def prepare_functions(self, fns: dict = None):
-        fns = fns or {}
-        cls_fns = {fn[3:]: getattr(self, fn) for fn in dir(self) if 'fn_' in fn}
-        result = {'F': update_recursive(fns, cls_fns)}
+        fns = dict(fns or {})
+        # none of them is a dict, plain update is the same as update_recursive
+        fns.update((fn[3:], getattr(self, fn)) for fn in self.get_fn_names())
+        result = {'F': fns}
         return result
 
+    @property
+    def fns(self):
+        """
+        Functions of the expressions, F.* are the user functions and the fn_
+        methods bound to this parser. They are built on first use, so a parse
+        context which evaluates no function never binds them.
+        """
+        fns = self._fns
+        if fns is None:
+            fns = self._fns = self.prepare_functions(fns=self._user_fns)
+        return fns
+
+    @fns.setter
+    def fns(self, fns: dict):
+        self._fns = fns
+        if self._evaluator is not None:
+            self._evaluator.functions = fns
+
+    @classmethod
+    def get_fn_names(cls):
+        """
+        Names of the fn_ methods, dir() is slow so the class is only scanned once
+        """
+        # read from the class itself, a subclass scans its own methods
+        names = cls.__dict__.get('_fn_names')
+        if names is None:
+            names = [fn for fn in dir(cls) if 'fn_' in fn]
+            cls._fn_names = names
+        return names
+
     def prepare_names(self, names: dict = None):
         names = names or {}
         names = names if isinstance(names, Munch2) else Munch2(names)
@@ -76,26 +205,171 @@ class Parser:
 
     def prepare_evaluator(self):
         """
-        Setup evaluator engine
+        Setup evaluator engine, one given back by a finished parse context is reused
 
         :return: Prepare evaluator engine
         """
         simpleeval_params = self.params.get('simpleeval', {})
-        # update simpleeval safety options
-        for k, v in simpleeval_params.get('options', {}).items():
-            setattr(simpleeval, k.upper(), v)
-        evaluator = EvalWithCompoundTypes()
-        # self._evals_functions should mirror self.fns
+        try:
+            evaluator = self._evaluators.pop()
+        except IndexError:
+            # safety options only apply to this evaluator, simpleeval module is left untouched
+            evaluator = self._evaluator_cls()
+        # self._evals_functions should mirror self.fns, they are only bound when an expression looks one up
         # TODO: Make a test to ensure proper mirroring
-        evaluator.functions = self.fns
+        evaluator.functions = self.fns if self._fns is not None else ParserFunctions(self)
         evaluator.names = self.names
-        # set the operators
-        if simpleeval_params.get('operators'):
-            evaluator.operators = simpleeval_params.get('operators')
+        # set the operators, simpleeval functions among them are the ones reading the options of this class
+        operators = simpleeval_params.get('operators')
+        if operators:
+            rebound = self._evaluator_cls.rebound_functions
+            evaluator.operators = {k: rebound.get(v, v) for k, v in operators.items()}
 
         return evaluator
 
-    def load(self, fs_path: str, fs_root: str = '', fs_include: list = None):
+    @property
+    def evaluator(self):
+        """
+        simpleeval evaluator of the parser, built on first use
+        """
+        evaluator = self._evaluator
+        if evaluator is None:
+            evaluator = self._evaluator = self.prepare_evaluator()
+        return evaluator
+
+    def clone(self):
+        """
+        New parser with the same names, functions and params, without the per
+        load state. It is cheaper than building the parser from scratch.
+        """
+        with self._lock:
+            parser = self._copy()
+        parser.parent = None
+        parser._lock = threading.RLock()
+        parser.reset()
+        return parser
+
+    def _copy(self):
+        parser = object.__new__(type(self))
+        parser.__dict__.update(self.__dict__)
+        parser.params = dict(self.params)
+        # Munch.update sets the names one by one
+        parser.names = Munch2()
+        dict.update(parser.names, self.names)
+        # the fn_ methods are bound to the copy on first use, user functions are shared
+        if self._fns is not None:
+            parser._fns, parser._user_fns = None, self._fns['F']
+        parser._evaluator = None
+        if parser.profiler is not None:
+            parser.profiler.attach(parser)
+        return parser
+
+    def context(self, shared: bool = False):
+        """
+        Parse context of a single load or parse call. It is a copy of the parser
+        with its own params (fs_path, fs_root), names (R, loop), evaluator,
+        errors and files, so one parser could serve calls from many threads at
+        once. Use merge_context to bring errors, files and names back.
+
+        :param shared: Append errors and files directly to the parser, for
+        calls which keep evaluating after they return e.g. lazy load
+        """
+        with self._lock:
+            ctx = self._copy()
+            if shared:
+                ctx.errors = self.errors
+                # files of the call, the parser does not keep the ones of the previous calls
+                self.files = ctx.files = []
+        ctx.parent = self
+        # the chain of files being loaded is per call, F.inc sub parser passes its chain on
+        ctx.include_stack = list(self.include_stack)
+        if not shared:
+            # the collector is only built on the first error
+            ctx._errors = None
+            ctx.files = []
+            ctx.template_stats = {'count': 0, 'render': 0.0, 'parse': 0.0}
+        return ctx
+
+    def merge_context(self, ctx, tracked: bool = False):
+        """
+        Merge the result of the context call into the parser. Errors are added
+        up, files of the configured parser are the ones of the last call.
+
+        :param tracked: Replace the tracked state by the one of the context
+        """
+        with self._lock:
+            if ctx.files is not self.files:
+                if ctx._errors is not None:
+                    self.errors.extend(ctx._errors)
+                if self.parent is None:
+                    self.files = ctx.files
+                else:
+                    self.files.extend(ctx.files)
+                if ctx.template_stats['count']:
+                    for k, v in ctx.template_stats.items():
+                        self.template_stats[k] += v
+                # the evaluator of a finished call serves the next one
+                if ctx._evaluator is not None:
+                    ctx._evaluator.names = ctx._evaluator.functions = None
+                    self._evaluators.append(ctx._evaluator)
+                    ctx._evaluator = None
+            if tracked:
+                self.tracked = ctx.tracked
+            dict.update(self.names, ((k, v) for k, v in dict.items(ctx.names) if k != 'loop'))
+
+    def call_in_context(self, name: str, *args, shared: bool = False, **kwargs):
+        ctx = self.context(shared=shared)
+        tracked = ctx.tracked
+        try:
+            return getattr(ctx, name)(*args, **kwargs)
+        finally:
+            self.merge_context(ctx, tracked=ctx.tracked is not tracked)
+
+    def freeze_result(self, data):
+        """
+        Immutable copy of the result when freeze param is set, lazy result is fully evaluated
+        """
+        return utils.freeze(data) if self.params.get('freeze') else data
+
+    @property
+    def errors(self):
+        """
+        Diagnostics of the errors, a parse context only builds it on its first error
+        """
+        errors = self._errors
+        if errors is None:
+            errors = self._errors = self.prepare_errors()
+        return errors
+
+    @errors.setter
+    def errors(self, errors):
+        # a plain list e.g. p.errors = [] to clear them is copied into a collector
+        if errors is not None and not isinstance(errors, Diagnostics):
+            diagnostics = self.prepare_errors()
+            diagnostics.extend(errors)
+            errors = diagnostics
+        self._errors = errors
+
+    def reset(self):
+        """
+        Clear the state left by the previous load or parse, so the parser could be reused
+        """
+        self._errors = None
+        self.files = []
+        self.tracked = None
+        self.includes = None
+        self.include_stack = []
+        self.secrets = None
+        self.preloaded = None
+        self._sub_parser = None
+        self.template_stats = {'count': 0, 'render': 0.0, 'parse': 0.0}
+        for k in ('fs_path', 'fs_root', 'R'):
+            self.params.pop(k, None)
+        for k in ('R', 'loop'):
+            self.names.pop(k, None)
+
+    def load(self, fs_path: str, fs_root: str = '', fs_include: list = None, lazy: bool = False,
+             track: bool = False):
         """
         Parse configuration file on disk.
 
@@ -109,110 +383,614 @@ class Parser:
         search for included files. Always contains the directory of the input
         file, and will also contain fs_root if specified.
         :type fs_include: list
+        :param lazy: Return LazyMunch which only evaluates the values, includes
+        and directives when they are first accessed
+        :type lazy: bool
+        :param track: Record the files and names every value depends on, so
+        reload only evaluates the values affected by changed files
+        :type track: bool
+        """
+        if self.parent is None:
+            return self.freeze_result(self.call_in_context(
+                'load', fs_path=fs_path, fs_root=fs_root, fs_include=fs_include, lazy=lazy, track=track, shared=lazy))
+        if lazy:
+            return self._load_lazy(fs_path=fs_path, fs_root=fs_root)
+        if track:
+            return self._load_tracked(fs_path=fs_path, fs_root=fs_root)
+        if self.includes is not None:
+            return self._load_cached(fs_path=fs_path, fs_root=fs_root)
+        self.includes = {}
+        self.secrets = {}
+        try:
+            return self._load_cached(fs_path=fs_path, fs_root=fs_root)
+        finally:
+            self.includes = None
+            self.secrets = None
+            self._sub_parser = None
+
+    async def aload(self, fs_path: str, fs_root: str = '', executor=None):
         """
+        Same as load for asyncio. The file and every F.inc file with constant
+        arguments are read and parsed concurrently in the executor, then the
+        config is evaluated in the executor too, the event loop is never blocked.
+
+        :param fs_path: The path to the file on disk
+        :type fs_path: str
+        :param fs_root: Root directory of fs_path
+        :type fs_root: str
+        :param executor: concurrent.futures executor, the default executor of the loop if not given
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        ctx = self.context()
+        ctx.preloaded = {}
+        try:
+            await ctx.preload(os.path.join(fs_root, fs_path), loop=loop, executor=executor, seen=set())
+            data = await loop.run_in_executor(executor, functools.partial(ctx.load, fs_path=fs_path, fs_root=fs_root))
+            return self.freeze_result(data)
+        finally:
+            self.merge_context(ctx)
+
+    async def preload(self, fs_file_path: str, loop, executor=None, seen: set = None):
+        """
+        Read the file and its F.inc files concurrently into self.preloaded
+        """
+        fs_abs_path = os.path.abspath(fs_file_path)
+        if fs_abs_path in seen:
+            return
+        seen.add(fs_abs_path)
+        try:
+            data = await loop.run_in_executor(executor, self.read_file, fs_abs_path)
+        except Exception:
+            # load reads it again, so the error is raised at the right place
+            return
+        self.preloaded[fs_abs_path] = data
+        fs_dir = os.path.dirname(fs_file_path)
+        includes = [os.path.join(inc_root or fs_dir, inc_path) for inc_path, inc_root in self.find_includes(data)]
+        import asyncio
+        await asyncio.gather(*(self.preload(path, loop=loop, executor=executor, seen=seen) for path in includes))
+
+    def _load_cached(self, fs_path: str, fs_root: str = ''):
+        cache_dir = self.params.get('cache_dir')
+        if not cache_dir:
+            return self._load(fs_path=fs_path, fs_root=fs_root)
+        # hashlib, pickle and tempfile are only imported once the cache is used
+        from conff.cache import LoadCache
+        # parse errors are not persisted, they only reported when the config is actually parsed
+        cache = LoadCache(cache_dir, ekey=self.params.get('ekey'))
+        key = cache.key(os.path.join(fs_root, fs_path), names=self.names, params=self.params, fns=self.fns)
+        entry = cache.get(key)
+        if entry is not None:
+            self.files.extend(fs_file_path for fs_file_path, _ in entry['files'])
+            self.names.update({'R': entry['data']})
+            return entry['data']
+        files_index = len(self.files)
+        data = self._load(fs_path=fs_path, fs_root=fs_root)
+        cache.set(key, files=self.files[files_index:], data=data)
+        return data
+
+    def _load(self, fs_path: str, fs_root: str = ''):
         fs_file_path = os.path.join(fs_root, fs_path)
         _, fs_file_ext = os.path.splitext(fs_file_path)
         fs_root = fs_root if fs_root is None else os.path.dirname(fs_file_path)
         self.params.update({'fs_path': fs_path, 'fs_root': fs_root})
+        fs_abs_path = os.path.abspath(fs_file_path)
+        if fs_abs_path in self.include_stack:
+            chain = self.include_stack[self.include_stack.index(fs_abs_path):] + [fs_abs_path]
+            raise ValueError('F.inc cycle detected: {}'.format(' -> '.join(chain)))
+        self.files.append(fs_abs_path)
+        self.include_stack.append(fs_abs_path)
+        try:
+            data = self._load_file(fs_file_path, fs_file_ext)
+        finally:
+            self.include_stack.pop()
+        # Delete anything specific to this file so we can reuse the parser
+        for k in ('fs_path', 'fs_root', 'R'):
+            if k in self.params:
+                del self.params[k]
+        return data
+
+    def _load_file(self, fs_file_path: str, fs_file_ext: str):
+        data = self.read_file(fs_file_path)
+        if 'yml' in fs_file_ext or 'json' in fs_file_ext:
+            names = {'R': data}
+            self.names.update(names)
+            if self.workers:
+                self.prefetch_includes(data)
+                self.prefetch_secrets(data)
+            data = self.process(data)
+        return data
+
+    def iter_load(self, fs_path: str, fs_root: str = ''):
+        """
+        Parse every document of a multi-document YAML file one at a time. Names
+        and params are shared across documents, R only refers to the current
+        document. Any other file type yields a single result of load.
+
+        :param fs_path: The path to the file on disk
+        :type fs_path: str
+        :param fs_root: Root directory of fs_path
+        :type fs_root: str
+        """
+        if self.parent is None:
+            ctx = self.context(shared=True)
+            try:
+                for data in ctx.iter_load(fs_path=fs_path, fs_root=fs_root):
+                    yield self.freeze_result(data)
+            finally:
+                self.merge_context(ctx)
+            return
+        fs_file_path = os.path.join(fs_root, fs_path)
+        _, fs_file_ext = os.path.splitext(fs_file_path)
+        if 'yml' not in fs_file_ext:
+            yield self.load(fs_path=fs_path, fs_root=fs_root)
+            return
+        fs_abs_path = os.path.abspath(fs_file_path)
+        self.files.append(fs_abs_path)
+        self.include_stack.append(fs_abs_path)
+        self.includes = {}
+        self.secrets = {}
+        try:
+            with open(fs_file_path) as stream:
+                for data in yaml_safe_load_all(stream):
+                    # set on every document, the parser could be used for something else in between
+                    self.params.update({'fs_path': fs_path, 'fs_root': os.path.dirname(fs_file_path)})
+                    self.names.update({'R': data})
+                    if self.workers:
+                        self.prefetch_includes(data)
+                        self.prefetch_secrets(data)
+                    yield self.process(data)
+        finally:
+            self.include_stack.remove(fs_abs_path)
+            self.includes = None
+            self.secrets = None
+            self._sub_parser = None
+            for k in ('fs_path', 'fs_root'):
+                self.params.pop(k, None)
+
+    def load_layers(self, fs_paths: list, fs_root: str = '', list_strategy: str = 'replace'):
+        """
+        Load every file (e.g. base, region, env and host overlays) and deep
+        merge them in order, value of the later layer wins. Each file is
+        parsed on its own, R refers to the file itself. The merge is a single
+        iterative pass over the keys the layers have in common, anything else
+        is taken as it is.
+
+        :param fs_paths: Paths of the files, relative to fs_root
+        :param list_strategy: How list in more than one layer is merged,
+        "replace", "append" or "unique" (append the items not in the list yet)
+        :return: Tuple of merged data and utils.Provenance, the layer of every value
+        """
+        if self.parent is None:
+            data, provenance = self.call_in_context('load_layers', fs_paths, fs_root=fs_root,
+                                                    list_strategy=list_strategy)
+            return self.freeze_result(data), provenance
+        if list_strategy not in utils.LIST_STRATEGIES:
+            raise ValueError('Unknown list strategy: {}'.format(list_strategy))
+        provenance = utils.Provenance(fs_paths)
+        data = None
+        for index, fs_path in enumerate(fs_paths):
+            layer = self.load(fs_path=fs_path, fs_root=fs_root)
+            if isinstance(data, dict) and isinstance(layer, dict):
+                utils.merge_layer(data, layer, index, provenance=provenance, list_strategy=list_strategy)
+            else:
+                data = layer
+                provenance.clear()
+                provenance[''] = index
+        return data, provenance
+
+    def reload(self):
+        """
+        Reload the file of the last load(..., track=True). Only the values
+        affected by changed files, directly or through R references, are
+        evaluated again.
+
+        :return: Tuple of parsed data and list of changed config paths, e.g.
+        "job.read_image.root_path"
+        """
+        if not self.tracked:
+            raise ValueError('Nothing to reload, use load(..., track=True) first')
+        if self.parent is None:
+            data, changed = self.call_in_context('reload')
+            return self.freeze_result(data), changed
+        from conff.cache import file_digest
+        tracked = self.tracked
+        files = {fs_file_path for fs_file_path, digest in tracked['files'].items()
+                 if file_digest(fs_file_path) != digest}
+        if not files:
+            return tracked['data'], []
+        fs_path, fs_root = tracked['fs_path'], tracked['fs_root']
+        data = self.read_file(os.path.join(fs_root, fs_path))
+        units, old_units = self.get_units(data), tracked['units']
+        dirty = {path for path in set(units) | set(old_units)
+                 if path not in units or path not in old_units or units[path] != old_units[path]['raw'] or
+                 files.intersection(old_units[path]['files'])}
+        # anything referring to a dirty value is dirty as well
+        refs = {path: self.find_references(raw) for path, raw in units.items()}
+        while True:
+            more = {path for path in units if path not in dirty and
+                    any(ref[:len(d)] == d[:len(ref)] for ref in refs[path] for d in dirty)}
+            if not more:
+                break
+            dirty.update(more)
+        data = self._load_tracked(fs_path=fs_path, fs_root=fs_root, data=data, old_units=old_units, dirty=dirty)
+        units = self.tracked['units']
+        changed = [path for path in dirty if path not in units or path not in old_units or
+                   units[path]['value'] != old_units[path]['value']]
+        return data, sorted('.'.join(str(k) for k in path) for path in changed)
+
+    def _load_tracked(self, fs_path: str, fs_root: str = '', data=None, old_units: dict = None, dirty: set = None):
+        fs_file_path = os.path.join(fs_root, fs_path)
+        _, fs_file_ext = os.path.splitext(fs_file_path)
+        if 'yml' not in fs_file_ext and 'json' not in fs_file_ext:
+            raise ValueError('Only YAML or JSON file could be tracked: {}'.format(fs_file_path))
+        fs_abs_path = os.path.abspath(fs_file_path)
+        files_index = len(self.files)
+        self.files.append(fs_abs_path)
+        self.include_stack.append(fs_abs_path)
+        self.includes = {}
+        self.params.update({'fs_path': fs_path, 'fs_root': os.path.dirname(fs_file_path)})
+        state = {'units': {}, 'old_units': old_units or {}, 'dirty': dirty or set()}
+        try:
+            data = self.read_file(fs_file_path) if data is None else data
+            self.names.update({'R': data})
+            data = self._process_tracked(data, (), state)
+        finally:
+            self.include_stack.pop()
+            self.includes = None
+            self._sub_parser = None
+            for k in ('fs_path', 'fs_root'):
+                self.params.pop(k, None)
+        from conff.cache import file_digest
+        self.tracked = {
+            'fs_path': fs_path, 'fs_root': fs_root, 'data': data, 'units': state['units'],
+            'files': {f: file_digest(f) for f in self.files[files_index:]}
+        }
+        return data
+
+    def _process_tracked(self, root, path: tuple, state: dict):
+        """
+        Same as _process but records every unit, a value which is evaluated as
+        a whole (string, list or dict with directives). Unit which is not dirty
+        reuses the value from the previous load.
+        """
+        if self.is_unit(root):
+            unit = state['old_units'].get(path)
+            if unit is not None and path not in state['dirty']:
+                self.files.extend(unit['files'])
+            else:
+                files_index = len(self.files)
+                raw = copy.deepcopy(root)
+                unit = {'raw': raw, 'value': self._process(root, path), 'files': self.files[files_index:]}
+            state['units'][path] = unit
+            return unit['value']
+        for k, v in root.items():
+            root[k] = self._process_tracked(v, path + (k,), state)
+        return root
+
+    def is_unit(self, value):
+        return type(value) not in (dict, odict) or any(str(k).startswith('F.') for k in value.keys())
+
+    def get_units(self, root, path: tuple = ()):
+        """
+        Raw value of every unit by its config path, see _process_tracked
+        """
+        if self.is_unit(root):
+            return {path: root}
+        units = {}
+        for k, v in root.items():
+            units.update(self.get_units(v, path + (k,)))
+        return units
+
+    def find_references(self, value, roots: tuple = ()):
+        """
+        Static R references in the raw value, each is a tuple of keys. Empty
+        tuple means anything in R could be read.
+
+        :param roots: Names which refer to the top level keys, other than R
+        """
+        refs = set()
+        if isinstance(value, dict):
+            if 'F.template' in value:
+                refs.add(())
+            for k, v in value.items():
+                refs.update(self.find_references(k, roots=roots))
+                refs.update(self.find_references(v, roots=roots))
+        elif isinstance(value, list):
+            for v in value:
+                refs.update(self.find_references(v, roots=roots))
+        elif isinstance(value, str) and ('R' in value or roots):
+            try:
+                refs.update(get_references(self.compile_expr(self.get_expr_text(value)), roots=roots))
+            except (SyntaxError, simpleeval.InvalidExpression):
+                pass
+        return refs
+
+    def _load_lazy(self, fs_path: str, fs_root: str = ''):
+        fs_file_path = os.path.join(fs_root, fs_path)
+        _, fs_file_ext = os.path.splitext(fs_file_path)
+        self.files.append(os.path.abspath(fs_file_path))
+        data = self.read_file(fs_file_path)
+        if 'yml' not in fs_file_ext and 'json' not in fs_file_ext:
+            return data
+        # state required to evaluate the values long after the load returned
+        context = {'params': {'fs_path': fs_path, 'fs_root': os.path.dirname(fs_file_path)}}
+        context['root'] = self.resolve_lazy(data, context=context)
+        return context['root']
+
+    def read_file(self, fs_file_path: str):
+        """
+        Read raw structure of the file, anything other than YAML or JSON is returned as text
+        """
+        if self.preloaded:
+            data = self.preloaded.pop(os.path.abspath(fs_file_path), None)
+            if data is not None:
+                return data
+        _, fs_file_ext = os.path.splitext(fs_file_path)
         with open(fs_file_path) as stream:
             if 'yml' in fs_file_ext:
                 # load_yaml initial structure
                 data = yaml_safe_load(stream)
-                names = {'R': data}
-                self.names.update(names)
-                data = self._process(data)
             elif 'json' in fs_file_ext:
+                import json
                 data = json.loads(stream.read())
-                names = {'R': data}
-                self.names.update(names)
-                data = self._process(data)
             else:
                 data = '\n'.join(stream.readlines())
-        # Delete anything specific to this file so we can reuse the parser
-        for k in ('fs_path', 'fs_root', 'R'):
-            if k in self.params:
-                del self.params[k]
         return data
 
+    def resolve_lazy(self, value, context: dict):
+        """
+        Evaluate value for LazyMunch, dict without any directive stays lazy
+        """
+        if type(value) in (dict, odict) and not any(str(k).startswith('F.') for k in value.keys()):
+            return LazyMunch(value, resolver=functools.partial(self.resolve_lazy, context=context))
+        params = {k: self.params[k] for k in context['params'] if k in self.params}
+        names = {k: self.names[k] for k in ('R',) if k in self.names}
+        self.params.update(context['params'])
+        self.names.update({'R': context['root']})
+        try:
+            return self._process(value)
+        finally:
+            for k in context['params']:
+                self.params.pop(k, None)
+            self.params.update(params)
+            self.names.pop('R', None)
+            self.names.update(names)
+
     def parse(self, data):
         """
         Main entry point to parse arbitary data type
         :param data: Input can be any data type such as dict, list, string, int
         :return: Parsed data
         """
+        if self.parent is None:
+            if isinstance(data, str) and self.is_literal(data):
+                # nothing is evaluated, no context is needed
+                return self.freeze_result(filter_value(data))
+            return self.freeze_result(self.call_in_context('parse', data))
         if isinstance(data, dict):
             if type(data) == dict:
                 warnings.warn('argument type is in dict, please use collections.OrderedDict for guaranteed order.')
             self.names.update(data)
-            result = self._process(data)
+            # keys of the data are the names here, instead of R
+            result = self.process(data, roots=tuple(k for k in data.keys() if isinstance(k, str)))
         else:
             result = self.parse_expr(data)
         return result
 
-    def parse_expr(self, expr: str):
+    def parse_expr(self, expr: str, path: tuple = ()):
         """
         Parse an expression in string
+
+        :param path: Config path of the expression, where its error is located
+        """
+        if isinstance(expr, str):
+            if self.is_literal(expr):
+                return filter_value(expr)
+            expr = self.get_expr_text(expr)
+        return self.eval_expr(expr, path=path)
+
+    def eval_expr(self, expr: str, node=None, path: tuple = ()):
+        """
+        Evaluate the expression text, errors are collected with the config path
+
+        :param node: Parsed AST of the expression, compiled from expr if not given
         """
         try:
-            v = self._evaluator.eval(expr=expr)
+            v = self.evaluator.eval(expr=expr, previously_parsed=node or self.compile_expr(expr))
         except SyntaxError as ex:
             v = expr
-            # TODO: feature T2
-            # print("Raised simpleeval exception {} for expression {}".format(type(ex), v))
-            self.errors.append([expr, ex])
+            # mostly a plain string which is not an expression, the traceback is not worth keeping
+            ex.__traceback__ = None
+            self.errors.add(ex, 'info', expression=expr, file=self.params.get('fs_path'), path=path)
         except simpleeval.InvalidExpression as ex:
             v = expr
-            # TODO: feature T2
-            # print("Raised simpleeval exception {} for expression {}".format(type(ex), v))
-            # print("Raised simpleeval exception {} for expression {}".format(type(ex), v))
-            # print("Message: {}".format(ex))
-            self.errors.append(ex)
+            ex.__traceback__ = None
+            self.errors.add(ex, 'warning', expression=expr, file=self.params.get('fs_path'), path=path)
         except Exception as ex:
             v = expr
-            # TODO: feature T2
-            # print('Exception on expression: {}'.format(expr))
-            self.errors.append(ex)
+            self.errors.add(ex, 'error', expression=expr, file=self.params.get('fs_path'), path=path)
             raise
         # TODO: feature T4: include this part of the classes so user could override
         v = filter_value(v)
         return v
 
-    def _process(self, root):
+    def is_literal(self, expr: str):
+        """
+        Cheap check whether a string could not be an expression, so it returned
+        as it is without raising and collecting error from the evaluator
+        """
+        text = expr.strip()
+        if self.params.get('expr_mode') == 'explicit':
+            return not text.startswith(self.params.get('expr_prefix'))
+        if not text or text[0] in LITERAL_START_CHARS or text == '[empty]':
+            return True
+        if '"' not in text and "'" not in text and LITERAL_CHARS_RE.search(text):
+            return True
+        if NAME_CHAIN_RE.match(text):
+            name = re.split(r'[.-]', text, 1)[0]
+            # the only name of the functions not built yet is F, see prepare_functions
+            fns = self._fns if self._fns is not None else ('F',)
+            return not (keyword.iskeyword(name) or name in self.names or name in fns)
+        return False
+
+    def get_expr_text(self, expr: str):
+        """
+        Expression to evaluate from a non literal string
+        """
+        if self.params.get('expr_mode') == 'explicit':
+            expr = expr.strip()[len(self.params.get('expr_prefix')):]
+        return expr
+
+    def compile_expr(self, expr: str):
+        """
+        Parse an expression into AST node, the result is cached by expression text
+        so repeated values across the config only parsed once
+        """
+        node = self.expr_cache.get(expr)
+        if node is None:
+            node = self._evaluator_cls.parse(expr)
+            self.expr_cache.set(expr, node)
+        return node
+
+    def process(self, root, roots: tuple = ()):
+        """
+        Process the whole document in the order of params eval_order
+
+        :param roots: Names which refer to the top level keys, other than R
+        """
+        if self.params.get('eval_order') == 'dependency':
+            order = self.plan(root, roots=roots)
+            if order == [()]:
+                return self._process(root)
+            for path in order:
+                parent = root
+                for k in path[:-1]:
+                    parent = parent[k]
+                parent[path[-1]] = self._process(parent[path[-1]], path)
+                if len(path) == 1 and path[0] in roots:
+                    self.names[path[0]] = parent[path[0]]
+            return root
+        return self._process(root)
+
+    def plan(self, root, roots: tuple = ()):
+        """
+        Order to evaluate the units (see _process_tracked) of the document, so
+        any unit is evaluated after the units it refers by R. Reference within
+        the same unit is left to _process.
+
+        :param roots: Names which refer to the top level keys, other than R
+        :return: List of unit paths
+        """
+        units = self.get_units(root)
+        if () in units:
+            return [()]
+        # units under any path, to quickly find what R.a.b refers to
+        under = {}
+        for path in units:
+            for i in range(len(path)):
+                under.setdefault(path[:i], []).append(path)
+        index = {path: i for i, path in enumerate(units)}
+        deps = {}
+        for path, raw in units.items():
+            found = []
+            for ref in self.find_references(raw, roots=roots):
+                if not ref:
+                    # could read anything, keep it after everything above as in document order
+                    found.extend(p for p in units if index[p] < index[path])
+                    continue
+                if ref[:len(path)] == path:
+                    continue
+                found.extend(ref[:i] for i in range(len(ref) + 1) if ref[:i] in units)
+                found.extend(under.get(ref, []))
+            deps[path] = [dep for dep in odict.fromkeys(found) if dep != path]
+        # depth first search in document order, iterative to support long chain of references
+        order, visited = [], {}
+        for start in units:
+            if start in visited:
+                continue
+            visited[start] = False
+            stack = [(start, iter(deps[start]))]
+            while stack:
+                path, it = stack[-1]
+                for dep in it:
+                    if visited.get(dep) is False:
+                        chain = [p for p, _ in stack]
+                        chain = chain[chain.index(dep):] + [dep]
+                        raise ValueError('Circular reference: {}'.format(
+                            ' -> '.join('.'.join(str(k) for k in p) for p in chain)))
+                    if dep not in visited:
+                        visited[dep] = False
+                        stack.append((dep, iter(deps[dep])))
+                        break
+                else:
+                    stack.pop()
+                    visited[path] = True
+                    order.append(path)
+        return order
+
+    def _process(self, root, path: tuple = ()):
         """
         The main parsing function
+
+        :param path: Config path of the root
         """
         root_type = type(root)
         if root_type == dict or root_type == odict:
             root_keys = list(root.keys())
+            # F.foreach iterates a range of its values without building the list
+            foreach = path and path[-1] == 'F.foreach'
             for k, v in root.items():
-                root[k] = self._process(v)
-            if 'F.extend' in root_keys:
-                root = self.fn_extend(root['F.extend'], root)
-                if isinstance(root, dict):
-                    del root['F.extend']
-            if 'F.template' in root_keys:
-                root = self.fn_template(root['F.template'], root)
-                if isinstance(root, dict):
-                    del root['F.template']
-            if 'F.update' in root_keys:
-                self.fn_update(root['F.update'], root)
-                del root['F.update']
-            if 'F.foreach' in root_keys:
-                for k in ('values', 'template'):
-                    if k not in root['F.foreach']:
-                        raise ValueError('F.foreach missing key: {}'.format(k))
-                self.fn_foreach(root['F.foreach'], root)
-                del root['F.foreach']
+                if foreach and k == 'values':
+                    root[k] = self.process_lazy_range(v, path + (k,))
+                else:
+                    root[k] = self._process(v, path + (k,))
+            root = self.process_directives(root, root_keys, path)
         elif root_type == list:
             for i, v in enumerate(root):
-                root[i] = self._process(root=v)
+                root[i] = self._process(v, path + (i,))
         elif root_type == str:
             value = root
             if type(value) == str:
-                value = self.parse_expr(root)
+                value = self.parse_expr(root, path)
             return value
         return root
 
+    def process_lazy_range(self, root, path: tuple = ()):
+        """
+        Same as _process, F.linspace and F.arange return LinearRange
+        """
+        lazy_range, self._lazy_range = self._lazy_range, True
+        try:
+            return self._process(root, path)
+        finally:
+            self._lazy_range = lazy_range
+
+    def process_directives(self, root, root_keys: list, path: tuple = ()):
+        """
+        Apply F.extend, F.template, F.update and F.foreach of the dict, its values are already processed
+
+        :param path: Config path of the dict
+        """
+        if 'F.extend' in root_keys:
+            root = self.fn_extend(root['F.extend'], root)
+            if isinstance(root, dict):
+                del root['F.extend']
+        if 'F.template' in root_keys:
+            root = self.fn_template(root['F.template'], root)
+            if isinstance(root, dict):
+                del root['F.template']
+        if 'F.update' in root_keys:
+            self.fn_update(root['F.update'], root)
+            del root['F.update']
+        if 'F.foreach' in root_keys:
+            for k in ('values', 'template'):
+                if k not in root['F.foreach']:
+                    raise ValueError('F.foreach missing key: {}'.format(k))
+            self.fn_foreach(root['F.foreach'], root, path=path)
+            del root['F.foreach']
+        return root
+
     def add_functions(self, funcs: dict):
         """
         Add functions to the list of available parsing function. Funcs should
@@ -235,6 +1013,7 @@ class Parser:
         """
         etype = self.params.get('etype')
         if etype == 'fernet':
+            from cryptography.fernet import Fernet
             key = Fernet.generate_key()
         else:
             key = None
@@ -257,7 +1036,7 @@ class Parser:
             return name in val
 
     def fn_next(self, vals, default=None):
-        vals = [vals] if type(vals) != list else vals
+        vals = vals if isinstance(vals, Sequence) and not isinstance(vals, (str, bytes)) else [vals]
         val = next(iter(vals), default)
         return val
 
@@ -271,31 +1050,39 @@ class Parser:
             val = val.strip(c)
         return val
 
+    def get_range(self, start, step, count: int):
+        value = LinearRange(start, step, count)
+        range_output = 'lazy' if self._lazy_range else self.params.get('range_output', 'list')
+        if range_output == 'list':
+            return value.tolist()
+        if range_output == 'numpy':
+            return value.toarray()
+        return value
+
     def fn_linspace(self, start, end, steps):
         delta = (end - start) / (steps - 1)
-        return [start + delta * i for i in range(steps)]
+        return self.get_range(start, delta, steps)
 
     def fn_arange(self, start, end, delta):
-        vals = [start]
-        while vals[-1] + delta <= end:
-            vals.append(vals[-1] + delta)
-        return vals
+        if delta <= 0:
+            raise ValueError('F.arange delta must be positive')
+        # count the values upfront instead of accumulating float error step by step
+        count = max(math.floor((end - start) / delta + 1e-9), 0) + 1
+        return self.get_range(start, delta, count)
 
     def fn_extend(self, val, val2):
-        val = copy.deepcopy(val)
-        type_val = type(val)
-        type_val2 = type(val2)
-        if type_val == list and type_val2 == list:
+        # the base is a live node of the result, the extended one never shares a container with it
+        val = copy_tree(val)
+        if isinstance(val, list) and isinstance(val2, list):
             val.extend(val2)
-        elif type_val in [dict, odict, Munch2] and type_val2 in [dict, odict, Munch2]:
+        elif isinstance(val, dict) and isinstance(val2, dict):
             for k, v in val2.items():
                 val[k] = v
         return val
 
     def fn_update(self, update, parent):
         def walk(u, p):
-            tu, tp = type(u), type(p)
-            if tu in [dict, odict, Munch2] and tp in [dict, odict, Munch2]:
+            if isinstance(u, dict) and isinstance(p, dict):
                 for k, v in u.items():
                     p[k] = walk(v, p.get(k, v))
                 return p
@@ -309,54 +1096,576 @@ class Parser:
         ekey = self.params.get('ekey', None)
         token = None
         if etype == 'fernet':
-            f = Fernet(ekey)
-            token = f.encrypt(data=str(data).encode()).decode()
+            f = utils.get_cipher(ekey)
+            token = f.encrypt(str(data).encode()).decode()
         return token
 
     def fn_decrypt(self, data):
+        if self.secrets and data in self.secrets:
+            return self.secrets[data]
         etype = self.params.get('etype', None)
         ekey = self.params.get('ekey', None)
         message = None
         if etype == 'fernet':
-            f = Fernet(ekey)
-            message = f.decrypt(token=str(data).encode()).decode()
+            f = utils.get_cipher(ekey)
+            message = f.decrypt(str(data).encode()).decode()
         return message
 
+    def encrypt_many(self, values: list, workers: int = None):
+        """
+        Encrypt values in bulk with the same cipher
+
+        :param workers: Number of threads, defaults to the parser workers
+        :return: List of tokens in the same order
+        """
+        return self.map_pool(self.fn_encrypt, values, workers=workers)
+
+    def decrypt_many(self, tokens: list, workers: int = None):
+        """
+        Decrypt tokens in bulk with the same cipher
+
+        :param workers: Number of threads, defaults to the parser workers
+        :return: List of messages in the same order
+        """
+        return self.map_pool(self.fn_decrypt, tokens, workers=workers)
+
+    def map_pool(self, fn, values: list, workers: int = None):
+        workers = workers or self.workers
+        if not workers:
+            return [fn(v) for v in values]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(fn, values))
+
+    def rotate_secrets(self, root):
+        """
+        Re-encrypt every F.decrypt token of the raw data with the first key of
+        ekey, tokens encrypted with any of the keys are accepted
+
+        :return: Copy of the raw data with the new tokens
+        """
+        cipher = utils.get_cipher(self.params.get('ekey'))
+        tokens = {t: cipher.rotate(t.encode()).decode() for t in self.find_secrets(root)}
+
+        def walk(value):
+            if isinstance(value, dict):
+                return type(value)((k, walk(v)) for k, v in value.items())
+            if isinstance(value, list):
+                return [walk(v) for v in value]
+            if isinstance(value, str):
+                for token, new_token in tokens.items():
+                    value = value.replace(token, new_token)
+            return value
+
+        return walk(root)
+
+    def find_calls(self, root, name: str):
+        """
+        Find F.<name> calls with constant string arguments in the raw data, these
+        do not depend on any names, so they could be run before processing
+
+        :return: List of (args, kwargs) in document order
+        """
+        result = []
+        root_type = type(root)
+        if root_type == dict or root_type == odict:
+            for v in root.values():
+                result.extend(self.find_calls(v, name))
+        elif root_type == list:
+            for v in root:
+                result.extend(self.find_calls(v, name))
+        elif root_type == str and 'F.' + name in root and not self.is_literal(root):
+            try:
+                node = getattr(self.compile_expr(self.get_expr_text(root)), 'value', None)
+            except (SyntaxError, simpleeval.InvalidExpression):
+                return result
+            is_call = isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                node.func.attr == name and isinstance(node.func.value, ast.Name) and node.func.value.id == 'F'
+            if not is_call:
+                return result
+            args = [get_constant(a) for a in node.args]
+            kwargs = {k.arg: get_constant(k.value) for k in node.keywords}
+            if all(isinstance(v, str) for v in args + list(kwargs.values())):
+                result.append((args, kwargs))
+        return result
+
+    def find_includes(self, root):
+        """
+        Find F.inc calls with constant arguments in the raw data, these do not
+        depend on any names, so they could be loaded before processing
+
+        :return: List of (fs_path, fs_root) in document order
+        """
+        result = []
+        for args, kwargs in self.find_calls(root, 'inc'):
+            fs_path = args[0] if args else kwargs.get('fs_path')
+            fs_root = args[1] if len(args) > 1 else kwargs.get('fs_root')
+            if fs_path:
+                result.append((fs_path, fs_root))
+        return result
+
+    def find_secrets(self, root):
+        """
+        Find F.decrypt tokens in the raw data
+
+        :return: List of unique tokens in document order
+        """
+        tokens = [args[0] if args else kwargs.get('data') for args, kwargs in self.find_calls(root, 'decrypt')]
+        return list(odict.fromkeys(t for t in tokens if t))
+
+    def prefetch_secrets(self, root):
+        """
+        Decrypt every F.decrypt token of the raw data in the thread pool
+        """
+        tokens = [t for t in self.find_secrets(root) if t not in self.secrets]
+
+        def decrypt(token):
+            try:
+                return self.fn_decrypt(token)
+            except Exception:
+                # F.decrypt decrypts it again, so the error is raised at the right place
+                return None
+
+        for token, message in zip(tokens, self.map_pool(decrypt, tokens)):
+            if message is not None:
+                self.secrets[token] = message
+
+    def prefetch_includes(self, root):
+        """
+        Load independent F.inc files in parallel into the include cache, errors
+        are collected per include in the order they appear in the document
+        """
+        futures = []
+        keys = set(self.includes)
+        params = dict(self.params, cache_dir=None, freeze=False)
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        pool_cls = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+        with pool_cls(max_workers=self.workers) as pool:
+            for fs_path, fs_root in self.find_includes(root):
+                fs_root = fs_root if fs_root else self.params['fs_root']
+                fs_file_path = os.path.abspath(os.path.join(fs_root, fs_path))
+                try:
+                    key = (fs_file_path, os.stat(fs_file_path).st_mtime_ns)
+                except OSError:
+                    continue
+                if key in keys:
+                    continue
+                keys.add(key)
+                futures.append((key, pool.submit(load_include, params, fs_path, fs_root)))
+        for key, future in futures:
+            try:
+                data, files, errors = future.result()
+            except Exception:
+                # F.inc loads it again, so the error is raised at the right place
+                continue
+            self.includes[key] = (data, files)
+            self.errors.extend(errors)
+
+    def get_sub_parser(self):
+        """
+        Sub parser to load F.inc files, it is reused for every include within the same load
+        """
+        if self._sub_parser is None:
+            # Make sure to pass on any modified options to the sub parser, the whole result is cached by the top parser
+            self._sub_parser = Parser(params=dict(self.params, cache_dir=None, freeze=False), profiler=self.profiler)
+        self._sub_parser.includes = self.includes
+        self._sub_parser.include_stack = self.include_stack
+        self._sub_parser.preloaded = self.preloaded
+        self._sub_parser.files = []
+        self._sub_parser.errors = self._sub_parser.prepare_errors()
+        return self._sub_parser
+
     def fn_inc(self, fs_path, fs_root: str = None):
         fs_root = fs_root if fs_root else self.params['fs_root']
-        # Make sure to pass on any modified options to the sub parser
-        sub_parser = Parser(params=self.params)
+        fs_file_path = os.path.abspath(os.path.join(fs_root, fs_path))
+        key = (fs_file_path, os.stat(fs_file_path).st_mtime_ns)
+        if self.includes is not None and key in self.includes:
+            data, files = self.includes[key]
+            self.files.extend(files)
+            # the result could be updated in place later, keep the cached one untouched
+            return copy_tree(data)
+        sub_parser = self.get_sub_parser()
         data = sub_parser.load(fs_path=fs_path, fs_root=fs_root)
+        self.files.extend(sub_parser.files)
+        self.errors.extend(sub_parser.errors)
+        if self.includes is not None:
+            self.includes[key] = (copy_tree(data), sub_parser.files)
         return data
 
-    def fn_foreach(self, foreach, parent):
+    def fn_foreach(self, foreach, parent, path: tuple = ()):
         template = foreach['template']
         if not isinstance(template, dict):
             raise ValueError('template item of F.foreach must be a dict')
-        for i, v in enumerate(foreach['values']):
-            self.names.update({'loop': {'index': i, 'value': v,
-                                        'length': len(foreach['values'])}})
-            result = {}
-            for key, val in template.items():
-                pkey = self.parse_expr(key)
-                pval = self._process(copy.copy(val))
-                result[pkey] = pval
-            parent.update(result)
-        # remove this specific foreach loop info from names dict so we don't
-        # break any subsequent foreach loops
-        del self.names['loop']
+        values = foreach['values']
+        length = len(values)
+        chunk = self.params.get('foreach_chunk')
+        outer = self.names.get('loop')
+        try:
+            items = enumerate(values)
+            if chunk and self.workers and length > chunk:
+                items = list(items)
+                # the plan is compiled once here, the chunks only run it
+                self.names['loop'] = {'index': 0, 'value': items[0][1], 'length': length}
+                plan = self.compile_foreach(template, path)
+                chunks = [items[i:i + chunk] for i in range(0, length, chunk)]
+                for ctx, results in self.map_pool(functools.partial(self.instantiate_chunk, plan, length=length,
+                                                                    path=path), chunks):
+                    self.merge_context(ctx)
+                    for result in results:
+                        parent.update(result)
+            else:
+                plan = None
+                for i, v in items:
+                    self.names['loop'] = {'index': i, 'value': v, 'length': length}
+                    if plan is None:
+                        plan = self.compile_foreach(template, path)
+                    parent.update(self.instantiate_foreach(plan, path))
+        finally:
+            # loop of an outer F.foreach is back for the rest of its item
+            if outer is None:
+                self.names.pop('loop', None)
+            else:
+                self.names['loop'] = outer
+
+    def compile_foreach(self, template: dict, path: tuple = ()):
+        """
+        Instantiation plan of the F.foreach template, names hold loop of the
+        first item. Strings which neither read loop nor call a function are
+        evaluated once here and shared by every item when the value is
+        immutable, the rest of the strings are parsed once and evaluated per
+        item. Dicts with directives are processed per item as before.
+
+        :param path: Config path of the dict with F.foreach, errors of the
+        static parts are only reported once, at the template
+        :return: List of (key node, value node) of the template items
+        """
+        path = path + ('F.foreach', 'template')
+        plan = []
+        for key, value in template.items():
+            key_node = self.compile_node(key, path) if isinstance(key, str) else (PLAN_PARSE, key)
+            plan.append((key_node, self.compile_node(value, path + (key,))))
+        return plan
+
+    def compile_node(self, value, path: tuple = ()):
+        if isinstance(value, str):
+            if self.is_literal(value):
+                return PLAN_STATIC, filter_value(value)
+            expr = self.get_expr_text(value)
+            try:
+                node = self.compile_expr(expr)
+            except (SyntaxError, simpleeval.InvalidExpression):
+                node = None
+            if node is not None and is_item_dependent(node):
+                return PLAN_EXPR, expr, node
+            result = self.parse_expr(value, path)
+            # immutable values evaluated once are shared by every item
+            if type(result) in IMMUTABLE_TYPES or node is None:
+                return PLAN_STATIC, result
+            # a fresh container for every item
+            return PLAN_EXPR, expr, node
+        if isinstance(value, dict):
+            if any(str(k).startswith('F.') for k in value.keys()):
+                return PLAN_PROCESS, value
+            return PLAN_DICT, [(k, self.compile_node(v, path + (k,))) for k, v in value.items()]
+        if isinstance(value, list):
+            return PLAN_LIST, [self.compile_node(v, path + (i,)) for i, v in enumerate(value)]
+        return PLAN_STATIC, value
+
+    def instantiate_foreach(self, plan: list, path: tuple = ()):
+        """
+        Items of the template for the loop in names, see compile_foreach
+
+        :param path: Config path of the dict with F.foreach, the items are added to
+        """
+        result = {}
+        for key_node, value_node in plan:
+            key = self.instantiate(key_node, path)
+            result[key] = self.instantiate(value_node, path + (key,))
+        return result
+
+    def instantiate(self, node: tuple, path: tuple = ()):
+        kind = node[0]
+        if kind == PLAN_STATIC:
+            return node[1]
+        if kind == PLAN_EXPR:
+            return self.eval_expr(node[1], node[2], path=path)
+        if kind == PLAN_DICT:
+            # same as processing a copy of the template dict, every value is set
+            return odict((k, self.instantiate(v, path + (k,))) for k, v in node[1])
+        if kind == PLAN_LIST:
+            return [self.instantiate(v, path + (i,)) for i, v in enumerate(node[1])]
+        if kind == PLAN_PARSE:
+            return self.parse_expr(node[1], path)
+        return self._process(copy_tree(node[1]), path)
+
+    def instantiate_chunk(self, plan: list, items: list, length: int, path: tuple = ()):
+        """
+        Items of a chunk of the F.foreach values in a context of its own
+
+        :return: Tuple of the context, to be merged, and list of the items of every value
+        """
+        ctx = self.context()
+        results = []
+        for i, v in items:
+            ctx.names['loop'] = {'index': i, 'value': v, 'length': length}
+            results.append(ctx.instantiate_foreach(plan, path))
+        return ctx, results
+
+    @classmethod
+    def get_template_env(cls, mode: str):
+        """
+        jinja2 environment of the template_mode, jinja2 is only imported once a template is used
+        """
+        env = cls.template_envs.get(mode)
+        if env is None:
+            if mode == 'native':
+                from jinja2.nativetypes import NativeEnvironment as env_cls
+            else:
+                from jinja2 import Environment as env_cls
+            env = cls.template_envs.setdefault(mode, env_cls())
+        return env
+
+    def get_template(self, template: str):
+        """
+        Compiled template, each source is compiled once
+        """
+        mode = self.params.get('template_mode', 'yaml')
+        key = (mode, template)
+        engine = self.template_cache.get(key)
+        if engine is None:
+            engine = self.get_template_env(mode).from_string(template)
+            self.template_cache.set(key, engine)
+        return engine
 
     def fn_template(self, template: str, root=None):
-        engine = Template(template)
-        obj_str = engine.render(**self.names)
-        result = obj_str
+        engine = self.get_template(template)
+        start = time.perf_counter()
+        obj = engine.render(**self.names)
+        parsed = time.perf_counter()
+        self.template_stats['count'] += 1
+        self.template_stats['render'] += parsed - start
+        result = obj
 
         # TODO: feature T2
-        obj = utils.yaml_safe_load(obj_str)
+        # rendered text is only parsed when it could extend the root
+        if root and isinstance(obj, str) and self.params.get('template_mode', 'yaml') == 'yaml':
+            obj = utils.yaml_safe_load(obj)
+            self.template_stats['parse'] += time.perf_counter() - parsed
         if root and isinstance(obj, dict):
             result = self.fn_extend(root, obj)
         return result
 
 
+# evaluator classes by their safety options
+_evaluator_classes = {}
+
+
+class ParserFunctions(Mapping):
+    """
+    Functions of the parser as its evaluator sees them, so they are only bound
+    once an expression looks one up
+    """
+    __slots__ = ('parser',)
+
+    def __init__(self, parser: Parser):
+        self.parser = parser
+
+    def __getitem__(self, k):
+        return self.parser.fns[k]
+
+    def __iter__(self):
+        return iter(self.parser.fns)
+
+    def __len__(self):
+        return len(self.parser.fns)
+
+
+def get_evaluator_cls(options: dict):
+    """
+    EvalWithCompoundTypes subclass with its own simpleeval safety options e.g.
+    max_power. simpleeval reads them from its module globals, so its functions
+    are rebound to a copy of the module namespace holding the options, instead
+    of changing them for the whole process. Classes are cached by options.
+    """
+    # frozen options e.g. the default ones are hashable, found without building the key
+    frozen = isinstance(options, utils.FrozenMunch)
+    cls = _evaluator_classes.get(options) if frozen else None
+    if cls is not None:
+        return cls
+    key = repr(sorted(options.items()))
+    cls = _evaluator_classes.get(key)
+    if cls is not None:
+        if frozen:
+            _evaluator_classes[options] = cls
+        return cls
+    namespace = dict(vars(simpleeval))
+    namespace.update((k.upper(), v) for k, v in options.items())
+
+    def rebind(fn):
+        return types.FunctionType(fn.__code__, namespace, fn.__name__, fn.__defaults__, fn.__closure__)
+
+    functions = {}
+    for name, value in vars(simpleeval).items():
+        if isinstance(value, types.FunctionType) and value.__module__ == simpleeval.__name__:
+            functions[value] = namespace[name] = rebind(value)
+    namespace['DEFAULT_OPERATORS'] = {k: functions.get(v, v) for k, v in simpleeval.DEFAULT_OPERATORS.items()}
+    attrs = {}
+    for base in reversed(EvalWithCompoundTypes.__mro__):
+        for name, value in vars(base).items():
+            if isinstance(value, types.FunctionType):
+                attrs[name] = rebind(value)
+            elif isinstance(value, staticmethod):
+                attrs[name] = staticmethod(rebind(value.__func__))
+
+    def __init__(self, operators=None, functions=None, names=None):
+        # SimpleEval.__init__ is reached by super(), so it still reads the module defaults
+        if operators is None:
+            operators = namespace['DEFAULT_OPERATORS'].copy()
+        EvalWithCompoundTypes.__init__(self, operators, functions, names)
+        self.ATTR_INDEX_FALLBACK = namespace['ATTR_INDEX_FALLBACK']
+
+    attrs['__init__'] = __init__
+    # simpleeval module function to its rebound copy, for the user given operators
+    attrs['rebound_functions'] = functions
+    cls = type('ConffEval', (EvalWithCompoundTypes,), attrs)
+    _evaluator_classes[key] = cls
+    if frozen:
+        _evaluator_classes[options] = cls
+    return cls
+
+
+def get_constant(node, default=None):
+    """
+    Value of literal node, Python < 3.8 parses literals into ast.Str, ast.Num
+    """
+    if type(node).__name__ not in CONSTANT_NODES:
+        return default
+    for attr in ('value', 's', 'n'):
+        if hasattr(node, attr):
+            return getattr(node, attr)
+    return default
+
+
+def is_item_dependent(node):
+    """
+    Whether the expression reads loop or calls a function, so it is evaluated for every F.foreach item
+    """
+    for n in ast.walk(node):
+        if isinstance(n, ast.Call) or (isinstance(n, ast.Name) and n.id == 'loop'):
+            return True
+    return False
+
+
+def get_references(node, name: str = 'R', roots: tuple = ()):
+    """
+    Keys chain of every attribute or constant subscript access on the name in
+    the expression node, e.g. R.a['b'].c is ('a', 'b', 'c'). Using the name
+    in any other way gives an empty tuple. Any of roots names is a top level
+    key by itself, e.g. a.b is ('a', 'b').
+    """
+    refs = set()
+
+    def get_base(n, keys):
+        if isinstance(n, ast.Name) and n.id == name:
+            return keys
+        if isinstance(n, ast.Name) and n.id in roots:
+            return (n.id,) + keys
+        return None
+
+    def get_chain(n):
+        keys = []
+        while True:
+            if isinstance(n, ast.Attribute):
+                keys.append(n.attr)
+            elif isinstance(n, ast.Subscript):
+                # Python < 3.9 wraps the subscript into ast.Index
+                key = n.slice.value if type(n.slice).__name__ == 'Index' else n.slice
+                if type(key).__name__ not in CONSTANT_NODES:
+                    break
+                keys.append(get_constant(key))
+            else:
+                break
+            n = n.value
+        return n, tuple(reversed(keys))
+
+    def visit(n):
+        if isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute):
+            # method call such as R.a.get('b'), the last key is the method
+            base, keys = get_chain(n.func)
+            keys = get_base(base, keys[:-1])
+            if keys is not None:
+                refs.add(keys)
+                for child in n.args + n.keywords:
+                    visit(child)
+                return
+        if isinstance(n, (ast.Attribute, ast.Subscript)):
+            base, keys = get_chain(n)
+            keys = get_base(base, keys)
+            if keys is not None:
+                refs.add(keys)
+                return
+        if isinstance(n, ast.Name) and (n.id == name or n.id in roots):
+            refs.add(get_base(n, ()))
+            return
+        for child in ast.iter_child_nodes(n):
+            visit(child)
+
+    visit(node)
+    return refs
+
+
+def load_include(params: dict, fs_path: str, fs_root: str):
+    """
+    Load F.inc file with its own parser, it is module level so it could run in a process pool
+
+    :return: Tuple of parsed data, files read and errors
+    """
+    parser = Parser(params=params)
+    data = parser.load(fs_path=fs_path, fs_root=fs_root)
+    # not every simpleeval exception could be sent back from another process
+    errors = parser.errors.records
+    for record in errors:
+        if not utils.is_picklable(record.error):
+            record.error = simpleeval.InvalidExpression(str(record.error))
+    return data, parser.files, errors
+
+
+class ParserPool(object):
+    """
+    Reuse clones of a configured parser, e.g. one parser per request in a web
+    server. Each parser is reset before it is handed out again.
+
+        pool = ParserPool(Parser(params=params))
+        with pool.parser() as p:
+            data = p.load('config.yml')
+    """
+
+    def __init__(self, parser: Parser, maxsize: int = 8):
+        self.template = parser
+        self.maxsize = maxsize
+        self._parsers = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._parsers:
+                return self._parsers.pop()
+        return self.template.clone()
+
+    def release(self, parser: Parser):
+        parser.reset()
+        with self._lock:
+            if len(self._parsers) < self.maxsize:
+                self._parsers.append(parser)
+
+    @contextlib.contextmanager
+    def parser(self):
+        parser = self.acquire()
+        try:
+            yield parser
+        finally:
+            self.release(parser)
+
+
 class ParserPlugin(object):
     pass
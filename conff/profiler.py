@@ -0,0 +1,184 @@
+import functools
+import logging
+import threading
+import time
+
+from conff.utils import count_leaves, odict
+
+logger = logging.getLogger('conff')
+
+# fn_ methods applied as directive keys of a dict, the in place ones return nothing
+DIRECTIVES = {
+    'fn_extend': ('F.extend', False),
+    'fn_template': ('F.template', False),
+    'fn_update': ('F.update', True),
+    'fn_foreach': ('F.foreach', True),
+}
+
+
+class Profiler(object):
+    """
+    Record wall time, number of calls and number of leaves produced per config
+    path and per directive (F.extend, F.template, F.update, F.foreach and every
+    F.* function call) while parsing. It is opt-in, the parser given to attach
+    gets timed wrappers as instance attributes, a parser without profiler runs
+    its plain methods. Times are inclusive, "own" time of a path excludes its
+    children and included files.
+    """
+
+    def __init__(self, hooks: list = None):
+        """
+        :param hooks: Callables called with the event dict of every record, with
+        keys kind ("path" or "directive"), name, file, path, seconds and nodes
+        """
+        self.hooks = list(hooks or [])
+        self.paths = {}
+        self.directives = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def reset(self):
+        with self._lock:
+            self.paths = {}
+            self.directives = {}
+
+    def attach(self, parser):
+        """
+        Install the timed wrappers on the parser, called again for every copy of it
+        """
+        cls = type(parser)
+        parser._process = functools.partial(self.process, parser)
+        for attr, (name, inplace) in DIRECTIVES.items():
+            setattr(parser, attr, self.wrap(parser, getattr(cls, attr).__get__(parser), name, inplace=inplace))
+        fns = parser.fns
+        fns['F'] = self.wrap_fns(parser, fns['F'], 'F')
+        return parser
+
+    def wrap_fns(self, parser, fns: dict, prefix: str):
+        """
+        Copy of the function table with every function wrapped, nested dict of functions included
+        """
+        cls = type(parser)
+        result = {}
+        for k, fn in fns.items():
+            name = '{}.{}'.format(prefix, k)
+            if isinstance(fn, dict):
+                result[k] = self.wrap_fns(parser, fn, name)
+                continue
+            fn = getattr(fn, '__wrapped__', fn)
+            # a copy of the parser shares the wrappers of the original, rebind the fn_ methods
+            if getattr(fn, '__func__', None) is not None and getattr(cls, fn.__name__, None) is fn.__func__:
+                fn = fn.__func__.__get__(parser)
+            result[k] = self.wrap(parser, fn, name)
+        return result
+
+    def wrap(self, parser, fn, name: str, inplace: bool = False):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            nodes = 0
+            try:
+                result = fn(*args, **kwargs)
+                nodes = count_leaves(args[1] if inplace else result)
+                return result
+            finally:
+                self.record('directive', name, parser, time.perf_counter() - start, nodes)
+        return wrapper
+
+    def process(self, parser, root, path: tuple = ()):
+        """
+        Parser._process timed, records every config path. The parser processes
+        the children through the same wrapper, their time and leaves are summed
+        up here instead of counting the leaves of every level again.
+        """
+        state = self._local
+        file = parser.params.get('fs_path') or ''
+        saved_file, saved_path = getattr(state, 'file', None), getattr(state, 'path', ())
+        saved_child, saved_nodes = getattr(state, 'child', 0.0), getattr(state, 'nodes', 0)
+        state.file, state.path, state.child, state.nodes = file, path, 0.0, 0
+        root_type = type(root)
+        # leaves of a dict with directives are only known once they are applied
+        count = root_type == str or ((root_type == dict or root_type == odict) and
+                                     any(str(k).startswith('F.') for k in root.keys()))
+        start = time.perf_counter()
+        try:
+            root = type(parser)._process(parser, root, path)
+        finally:
+            elapsed = time.perf_counter() - start
+            own = elapsed - state.child
+            nodes = state.nodes
+            state.file, state.path, state.nodes = saved_file, saved_path, saved_nodes
+            state.child = saved_child + elapsed
+        if count:
+            nodes = count_leaves(root)
+        elif root_type != list and root_type != dict and root_type != odict:
+            nodes = 1
+        state.nodes += nodes
+        self.record('path', '.'.join(str(k) for k in path), parser, elapsed, nodes, own=own)
+        return root
+
+    def record(self, kind: str, name: str, parser, seconds: float, nodes: int, own: float = None):
+        file = parser.params.get('fs_path') or ''
+        if kind == 'path':
+            key, stats = (file, name), self.paths
+        else:
+            key, stats = name, self.directives
+        with self._lock:
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = {'count': 0, 'seconds': 0.0, 'own': 0.0, 'nodes': 0}
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['own'] += seconds if own is None else own
+            entry['nodes'] += nodes
+        if self.hooks:
+            path = name if kind == 'path' else '.'.join(str(k) for k in getattr(self._local, 'path', ()))
+            event = {'kind': kind, 'name': name, 'file': file, 'path': path,
+                     'seconds': seconds, 'nodes': nodes}
+            for hook in self.hooks:
+                try:
+                    hook(event)
+                except Exception as ex:
+                    logger.warning('Profiler hook {} failed: {}'.format(hook, ex))
+
+    def report(self, top: int = None):
+        """
+        :param top: Only keep the slowest entries of each list
+        :return: dict with "paths", "directives" and "files", lists of stats
+        sorted by seconds, slowest first. Seconds of a file is the own time
+        of its paths.
+        """
+        with self._lock:
+            paths = [dict(entry, file=file, path=path) for (file, path), entry in self.paths.items()]
+            directives = [dict(entry, name=name) for name, entry in self.directives.items()]
+        files = {}
+        for entry in paths:
+            files[entry['file']] = files.get(entry['file'], 0.0) + entry['own']
+        result = {
+            'paths': sorted(paths, key=lambda e: e['seconds'], reverse=True),
+            'directives': sorted(directives, key=lambda e: e['seconds'], reverse=True),
+            'files': sorted(({'file': k, 'seconds': v} for k, v in files.items()),
+                            key=lambda e: e['seconds'], reverse=True),
+        }
+        if top is not None:
+            result = {k: v[:top] for k, v in result.items()}
+        return result
+
+    def format(self, top: int = 10):
+        """
+        Report as text table
+        """
+        report = self.report(top=top)
+        lines = ['{:<40}{:>8}{:>12}{:>12}{:>10}'.format('path', 'count', 'seconds', 'own', 'nodes')]
+        for e in report['paths']:
+            name = e['path'] or '<root>'
+            name = '{}:{}'.format(e['file'], name) if e['file'] else name
+            lines.append('{:<40}{count:>8}{seconds:>12.6f}{own:>12.6f}{nodes:>10}'.format(name, **e))
+        lines.append('{:<40}{:>8}{:>12}{:>12}{:>10}'.format('directive', 'count', 'seconds', '', 'nodes'))
+        for e in report['directives']:
+            lines.append('{name:<40}{count:>8}{seconds:>12.6f}{:>12}{nodes:>10}'.format('', **e))
+        return '\n'.join(lines)
@@ -0,0 +1,383 @@
+"""
+Read-only snapshot of a parsed config in a memory-mapped file. Every process
+which attaches to the same file shares one copy of it in the page cache, values
+are only decoded when they are accessed. Write it once e.g. before forking the
+workers, then attach in every worker:
+
+    snapshot.dump(conff.load('config.yml'), 'config.snapshot')
+    config = snapshot.attach('config.snapshot')
+    config.db.host
+
+File layout, little endian, a node is a tag byte followed by its payload:
+
+    header   b'CONFFSNP', version u32, root offset u32
+    None/True/False   tag only
+    int      int64, bigger ones as decimal text
+    float    float64
+    str      length u32, utf-8
+    bytes    length u32, raw
+    pickle   length u32, pickled value of any other type e.g. date
+    list     count u32, offset u32 of every item
+    dict     count u32, number of slots u32, entries (key offset u32, key
+             length u32, value offset u32) in the original order, then the
+             hash table slots (crc32 of the key node u32, entry index + 1 u32)
+
+Offsets are u32, a snapshot is at most 4 GiB.
+"""
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+from collections.abc import Mapping, Sequence
+
+from conff.utils import LinearRange, odict
+
+MAGIC = b'CONFFSNP'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+U32 = struct.Struct('<I')
+I64 = struct.Struct('<q')
+F64 = struct.Struct('<d')
+ENTRY = struct.Struct('<III')
+SLOT = struct.Struct('<II')
+COUNT = struct.Struct('<II')
+MAX_SIZE = 2 ** 32
+SCALAR_TYPES = frozenset((str, int, float, bool, bytes, type(None)))
+TAG_NONE, TAG_TRUE, TAG_FALSE = b'N', b'T', b'F'
+TAG_INT, TAG_BIGINT, TAG_FLOAT, TAG_STR, TAG_BYTES = b'i', b'I', b'f', b's', b'b'
+TAG_LIST, TAG_DICT, TAG_PICKLE = b'l', b'd', b'p'
+
+
+def encode_scalar(value):
+    """
+    Node bytes of a scalar, None if the value is not a scalar
+    """
+    if value is None:
+        return TAG_NONE
+    if value is True:
+        return TAG_TRUE
+    if value is False:
+        return TAG_FALSE
+    value_type = type(value)
+    if value_type == str:
+        raw = value.encode('utf-8')
+        return TAG_STR + U32.pack(len(raw)) + raw
+    if value_type == int:
+        if -2 ** 63 <= value < 2 ** 63:
+            return TAG_INT + I64.pack(value)
+        raw = str(value).encode()
+        return TAG_BIGINT + U32.pack(len(raw)) + raw
+    if value_type == float:
+        return TAG_FLOAT + F64.pack(value)
+    if value_type == bytes:
+        return TAG_BYTES + U32.pack(len(value)) + value
+    return None
+
+
+class SnapshotWriter(object):
+    """
+    Serialise nested dict and list into snapshot bytes, children are written
+    before their parent. Equal scalars and containers referred from many
+    places are written once.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray(HEADER.pack(MAGIC, VERSION, 0))
+        self.scalars = {}
+        self.containers = {}
+
+    def write(self, raw: bytes):
+        offset = len(self.buffer)
+        if offset + len(raw) > MAX_SIZE:
+            raise ValueError('Snapshot is bigger than {} bytes'.format(MAX_SIZE))
+        self.buffer += raw
+        return offset
+
+    def add(self, value):
+        """
+        :return: Tuple of offset and length of the node
+        """
+        value_type = type(value)
+        if value_type in SCALAR_TYPES:
+            # True == 1, the type keeps them apart
+            key = (value_type, value)
+            node = self.scalars.get(key)
+            if node is None:
+                raw = encode_scalar(value)
+                node = self.scalars[key] = (self.write(raw), len(raw))
+            return node
+        if isinstance(value, Mapping) or (isinstance(value, Sequence) and not isinstance(value, (str, bytes))):
+            node = self.containers.get(id(value))
+            if node == ():
+                raise ValueError('Circular reference could not be written to snapshot')
+            if node is None:
+                self.containers[id(value)] = ()
+                node = self.add_dict(value) if isinstance(value, Mapping) else self.add_list(value)
+                # keep the value alive, so its id is not reused
+                self.containers[id(value)] = node + (value,)
+            return node[:2]
+        raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        raw = TAG_PICKLE + U32.pack(len(raw)) + raw
+        return self.write(raw), len(raw)
+
+    def add_list(self, value):
+        add = self.add
+        offsets = [add(v)[0] for v in value]
+        raw = TAG_LIST + U32.pack(len(offsets)) + struct.pack('<{}I'.format(len(offsets)), *offsets)
+        return self.write(raw), len(raw)
+
+    def add_dict(self, value):
+        add, buffer = self.add, self.buffer
+        entries = []
+        for k, v in value.items():
+            if type(k) not in SCALAR_TYPES:
+                raise TypeError('Unsupported key type of snapshot: {!r}'.format(k))
+            key_offset, key_length = add(k)
+            entries.extend((key_offset, key_length, add(v)[0]))
+        count = len(entries) // 3
+        # at most 3/4 of the slots are used
+        nslots = 2
+        while nslots * 3 < count * 4:
+            nslots *= 2
+        mask = nslots - 1
+        slots = [0] * (nslots * 2)
+        for index in range(count):
+            key_offset, key_length = entries[index * 3], entries[index * 3 + 1]
+            key_hash = zlib.crc32(buffer[key_offset:key_offset + key_length])
+            slot = key_hash & mask
+            while slots[slot * 2 + 1]:
+                slot = (slot + 1) & mask
+            slots[slot * 2], slots[slot * 2 + 1] = key_hash, index + 1
+        raw = (TAG_DICT + COUNT.pack(count, nslots) + struct.pack('<{}I'.format(len(entries)), *entries) +
+               struct.pack('<{}I'.format(len(slots)), *slots))
+        return self.write(raw), len(raw)
+
+    def getvalue(self, value):
+        root, _ = self.add(value)
+        self.buffer[:HEADER.size] = HEADER.pack(MAGIC, VERSION, root)
+        return bytes(self.buffer)
+
+
+def dumps(value):
+    return SnapshotWriter().getvalue(value)
+
+
+def dump(value, fs_path: str):
+    """
+    Write the snapshot atomically, processes attached to the previous file keep reading it
+    """
+    raw = dumps(value)
+    fs_dir = os.path.dirname(os.path.abspath(fs_path))
+    fd, tmp_path = tempfile.mkstemp(dir=fs_dir)
+    with os.fdopen(fd, 'wb') as stream:
+        stream.write(raw)
+    os.replace(tmp_path, fs_path)
+
+
+class Snapshot(object):
+    """
+    Memory-mapped snapshot file, root is SnapshotMunch or SnapshotList
+    """
+
+    def __init__(self, fs_path: str):
+        with open(fs_path, 'rb') as stream:
+            self.buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, root = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.buffer.close()
+            raise ValueError('Not a conff snapshot or unsupported version: {}'.format(fs_path))
+        self.view = memoryview(self.buffer)
+        self.root = self.node(root)
+
+    def node(self, offset: int):
+        buffer = self.buffer
+        tag = buffer[offset:offset + 1]
+        if tag == TAG_STR:
+            length, = U32.unpack_from(buffer, offset + 1)
+            return str(self.view[offset + 5:offset + 5 + length], 'utf-8')
+        if tag == TAG_INT:
+            return I64.unpack_from(buffer, offset + 1)[0]
+        if tag == TAG_DICT:
+            return SnapshotMunch(self, offset)
+        if tag == TAG_LIST:
+            return SnapshotList(self, offset)
+        if tag == TAG_FLOAT:
+            return F64.unpack_from(buffer, offset + 1)[0]
+        if tag == TAG_NONE:
+            return None
+        if tag == TAG_TRUE:
+            return True
+        if tag == TAG_FALSE:
+            return False
+        length, = U32.unpack_from(buffer, offset + 1)
+        raw = self.view[offset + 5:offset + 5 + length]
+        if tag == TAG_BIGINT:
+            return int(bytes(raw))
+        if tag == TAG_BYTES:
+            return bytes(raw)
+        if tag == TAG_PICKLE:
+            return pickle.loads(raw)
+        raise ValueError('Corrupted snapshot at {}'.format(offset))
+
+    def lookup(self, path, default=None):
+        """
+        Value at the path, dotted string e.g. "a.b.0" or tuple of keys
+        """
+        keys = path.split('.') if isinstance(path, str) else path
+        value = self.root
+        for k in keys:
+            try:
+                if isinstance(value, SnapshotList):
+                    value = value[int(k)]
+                elif isinstance(value, SnapshotMunch):
+                    value = value[k]
+                else:
+                    return default
+            except (KeyError, IndexError, ValueError):
+                return default
+        return value
+
+    def close(self):
+        self.view.release()
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SnapshotMunch(Mapping):
+    """
+    Read-only dict of the snapshot with dot-access like Munch2, key lookup is a hash table probe in the file
+    """
+    __slots__ = ('_snapshot', '_offset', '_count', '_nslots')
+
+    def __init__(self, snapshot: Snapshot, offset: int):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_offset', offset)
+        count, nslots = COUNT.unpack_from(snapshot.buffer, offset + 1)
+        object.__setattr__(self, '_count', count)
+        object.__setattr__(self, '_nslots', nslots)
+
+    def _entry(self, index: int):
+        return ENTRY.unpack_from(self._snapshot.buffer, self._offset + 1 + COUNT.size + ENTRY.size * index)
+
+    def _find(self, k):
+        value_offset = self._probe(encode_scalar(k))
+        # as in dict, True and 1 are the same key
+        if value_offset is None and (k is True or k is False or (type(k) == int and k in (0, 1))):
+            value_offset = self._probe(encode_scalar(int(k) if type(k) == bool else bool(k)))
+        return value_offset
+
+    def _probe(self, raw: bytes):
+        if raw is None:
+            return None
+        snapshot = self._snapshot
+        key_hash = zlib.crc32(raw)
+        mask = self._nslots - 1
+        slots = self._offset + 1 + COUNT.size + ENTRY.size * self._count
+        slot = key_hash & mask
+        while True:
+            slot_hash, index = SLOT.unpack_from(snapshot.buffer, slots + SLOT.size * slot)
+            if not index:
+                return None
+            if slot_hash == key_hash:
+                key_offset, key_length, value_offset = self._entry(index - 1)
+                if snapshot.view[key_offset:key_offset + key_length] == raw:
+                    return value_offset
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, k):
+        value_offset = self._find(k)
+        if value_offset is None:
+            raise KeyError(k)
+        return self._snapshot.node(value_offset)
+
+    def __contains__(self, k):
+        return self._find(k) is not None
+
+    def __getattr__(self, k):
+        if k in SnapshotMunch.__slots__:
+            raise AttributeError(k)
+        try:
+            return self[k]
+        except KeyError:
+            raise AttributeError(k)
+
+    def __setattr__(self, k, v):
+        raise TypeError('{} is read-only'.format(type(self).__name__))
+
+    def __iter__(self):
+        node = self._snapshot.node
+        for index in range(self._count):
+            yield node(self._entry(index)[0])
+
+    def __len__(self):
+        return self._count
+
+    def __repr__(self):
+        return '{}(offset={})'.format(type(self).__name__, self._offset)
+
+    def toDict(self):
+        return to_python(self)
+
+
+class SnapshotList(Sequence):
+    """
+    Read-only list of the snapshot, compares equal to list or tuple with the same values
+    """
+    __slots__ = ('_snapshot', '_offset', '_count')
+
+    def __init__(self, snapshot: Snapshot, offset: int):
+        object.__setattr__(self, '_snapshot', snapshot)
+        object.__setattr__(self, '_offset', offset)
+        object.__setattr__(self, '_count', U32.unpack_from(snapshot.buffer, offset + 1)[0])
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(self._count)[i]]
+        i = range(self._count)[i]
+        offset, = U32.unpack_from(self._snapshot.buffer, self._offset + 5 + 4 * i)
+        return self._snapshot.node(offset)
+
+    def __setattr__(self, k, v):
+        raise TypeError('{} is read-only'.format(type(self).__name__))
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, LinearRange, SnapshotList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}(offset={}, count={})'.format(type(self).__name__, self._offset, self._count)
+
+
+def to_python(value):
+    """
+    Copy of the snapshot value as OrderedDict and list
+    """
+    if isinstance(value, SnapshotMunch):
+        return odict((k, to_python(v)) for k, v in value.items())
+    if isinstance(value, SnapshotList):
+        return [to_python(v) for v in value]
+    return value
+
+
+def attach(fs_path: str):
+    """
+    Root of the snapshot file, it costs the same whatever the size of the snapshot
+    """
+    return Snapshot(fs_path).root
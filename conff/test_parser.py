@@ -1,11 +1,19 @@
+import copy
+import json
 import os
 import tempfile
 import shutil
 from distutils.dir_util import copy_tree
+import unittest
 from unittest import TestCase
 import yaml
 import conff
-from conff import utils
+from conff import diagnostics, utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class ConffTestCase(TestCase):
@@ -241,3 +249,659 @@ class ConffTestCase(TestCase):
             "test_4_6": 6
         }
         self.assertDictEqual(data.get('test_4'), data_test_4)
+
+    def test_expr_cache(self):
+        conff.Parser.expr_cache.clear()
+        p = conff.Parser()
+        data = p.parse(utils.odict([('a', '1 + 2'), ('b', '1 + 2'), ('c', 'F.str(1)')]))
+        self.assertDictEqual(data, {'a': 3, 'b': 3, 'c': '1'})
+        self.assertDictEqual(p.expr_cache.info(), {'hits': 1, 'misses': 2, 'size': 2, 'maxsize': 4096})
+        # cache is shared with other parsers
+        p2 = conff.Parser()
+        self.assertEqual(p2.parse('1 + 2'), 3)
+        self.assertEqual(p2.expr_cache.hits, 2)
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_literal(self):
+        p = conff.Parser(names={'c': {'d': 1}})
+        data = p.parse(utils.odict([
+            ('t1', 'api.example.com'), ('t2', 'ap-southeast-2'), ('t3', '/data/project'), ('t4', 'http://host:80/'),
+            ('t5', '[empty]'), ('t6', 'c.d + 1'), ('t7', 'True'), ('t8', 'c.e')
+        ]))
+        self.assertDictEqual(data, {'t1': 'api.example.com', 't2': 'ap-southeast-2', 't3': '/data/project',
+                                    't4': 'http://host:80/', 't5': '', 't6': 2, 't7': True, 't8': 'c.e'})
+        # only the last one is attempted, c is known name
+        self.assertEqual(len(p.errors), 1)
+
+    def test_explicit_expr_mode(self):
+        p = conff.Parser(params={'expr_mode': 'explicit'})
+        data = p.parse(utils.odict([('a', '1 + 2'), ('b', '=1 + 2'), ('c', "= F.str(1) + 'a'")]))
+        self.assertDictEqual(data, {'a': '1 + 2', 'b': 3, 'c': '1a'})
+        self.assertEqual(p.errors, [])
+
+    def test_load_cache(self):
+        cache_dir = os.path.join(self.test_data_path, 'cache')
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        params = {'ekey': ekey, 'cache_dir': cache_dir}
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        r1 = conff.Parser(params=params).load(fs_path)
+        p = conff.Parser(params=params)
+        r2 = p.load(fs_path)
+        self.assertDictEqual(r1, r2)
+        # served from cache, nothing is parsed
+        self.assertEqual(p.errors, [])
+        self.assertListEqual(p.files, [fs_path, self.get_test_data_path('test_config_01.yml')])
+        # decrypted values are not stored as plain text
+        for fs_cache_path in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, fs_cache_path), 'rb') as stream:
+                self.assertNotIn(b'test_11', stream.read())
+        # changing included file invalidates the cache
+        with open(self.get_test_data_path('test_config_01.yml'), 'w') as stream:
+            stream.write('test_1: changed\n')
+        r3 = conff.Parser(params=params).load(fs_path)
+        self.assertDictEqual(r3.get('test_12'), {'test_1': 'changed'})
+        # user functions are part of the key
+
+        def fn_one():
+            return 1
+
+        def fn_two():
+            return 2
+
+        fs_path = self.get_test_data_path('fns.yml')
+        with open(fs_path, 'w') as stream:
+            stream.write('a: F.value()\n')
+        self.assertEqual(conff.Parser(params=params, fns={'value': fn_one}).load(fs_path), {'a': 1})
+        self.assertEqual(conff.Parser(params=params, fns={'value': fn_two}).load(fs_path), {'a': 2})
+        self.assertEqual(conff.Parser(params=params, fns={'value': fn_one}).load(fs_path), {'a': 1})
+        # entries are unpickled, a directory other users could write is refused
+        self.assertEqual(os.stat(cache_dir).st_mode & 0o777, 0o700)
+        os.chmod(cache_dir, 0o777)
+        with self.assertRaises(ValueError):
+            conff.Parser(params=params).load(fs_path)
+
+    def test_inc_cache(self):
+        fs_path = self.get_test_data_path('test_config_06.yml')
+        p = conff.Parser()
+        data = p.load(fs_path)
+        self.assertDictEqual(data, {'test_1': {'test_1': 'test_1', 'test_2': ''},
+                                    'test_2': {'test_1': 'test_1', 'test_2': ''}})
+        self.assertIsNot(data['test_1'], data['test_2'])
+        self.assertEqual(p.files.count(self.get_test_data_path('test_config_01.yml')), 2)
+        self.assertIsNone(p.includes)
+
+    def test_error_inc_cycle(self):
+        p = conff.Parser()
+        fs_path = self.get_test_data_path('malformed_inc_01.yml')
+        with self.assertRaises(ValueError) as context:
+            p.load(fs_path=fs_path)
+        self.assertIn('cycle', str(context.exception))
+        self.assertListEqual(p.include_stack, [])
+
+    def test_inc_workers(self):
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        r1 = conff.Parser(params={'ekey': ekey}).load(fs_path)
+        for executor in ('thread', 'process'):
+            p = conff.Parser(params={'ekey': ekey}, workers=2, executor=executor)
+            r2 = p.load(fs_path)
+            self.assertDictEqual(r1, r2)
+            self.assertListEqual(p.find_includes(utils.odict([('a', "F.inc('a.yml')"), ('b', ["F.inc('b.yml', 'c')"]),
+                                                              ('c', 'F.inc(R.a)')])),
+                                 [('a.yml', None), ('b.yml', 'c')])
+
+    def test_lazy_load(self):
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        r1 = conff.Parser(params={'ekey': ekey}).load(fs_path)
+        r2 = conff.Parser(params={'ekey': ekey}).load(fs_path, lazy=True)
+        self.assertDictEqual(r2, r1)
+        p = conff.Parser()
+        data = p.load(self.get_test_data_path('test_config_07.yml'), lazy=True)
+        self.assertIsInstance(data, utils.LazyMunch)
+        self.assertEqual(data.test_3.test_3_1, 4)
+        self.assertDictEqual(data.test_3.test_3_2, {'test_1': 'test_1', 'test_2': ''})
+        self.assertDictEqual(data.test_5, {'test_3_1': 4, 'test_3_2': {'test_1': 'test_1', 'test_2': ''},
+                                           'test_5_1': 1})
+        with self.assertRaises(ZeroDivisionError):
+            data.get('test_2')
+        # copies through dict() and ** unpacking resolve the values too
+        data = p.load(self.get_test_data_path('test_config_07.yml'), lazy=True)
+        self.assertEqual(dict(data.test_3)['test_3_1'], 4)
+        self.assertEqual({**data.test_5}['test_3_1'], 4)
+        self.assertDictEqual(dict(**data.test_3.test_3_2), {'test_1': 'test_1', 'test_2': ''})
+
+    def test_iter_load(self):
+        p = conff.Parser(names={'domain': 'example.com'})
+        fs_path = self.get_test_data_path('test_config_08.yml')
+        data = list(p.iter_load(fs_path))
+        self.assertEqual(len(data), 3)
+        self.assertDictEqual(data[0], {'tenant': 't1', 'url': 'http://t1.example.com'})
+        self.assertDictEqual(data[1], {'tenant': 't2', 'url': 'http://t2.example.com',
+                                       'shared': {'test_1': 'test_1', 'test_2': ''}})
+        self.assertDictEqual(data[2], {'tenant': 't3', 'port': 81})
+        self.assertNotIn('fs_root', p.params)
+        # non YAML file is a single document
+        data = list(p.iter_load(self.get_test_data_path('test_config_01.json')))
+        self.assertListEqual(data, [{'test_1': 1, 'test_2': 2}])
+
+    def test_yaml_loader(self):
+        from conff import benchmark
+        for name, text in benchmark.get_fixtures():
+            text = benchmark.scale_yaml(text, 2)
+            r1 = utils.yaml_safe_load(text, loader_cls=utils.get_yaml_loader(pure=True))
+            r2 = utils.yaml_safe_load(text)
+            self.assertEqual(r1, r2)
+            self.assertIsInstance(r2, utils.odict)
+            self.assertListEqual(list(r1['copy_0']), list(r2['copy_0']))
+
+    def test_reload(self):
+        fs_path = self.get_test_data_path('test_config_09.yml')
+        calls = []
+
+        class SpyParser(conff.Parser):
+            def fn_inc(self, *args):
+                calls.append(args)
+                return super().fn_inc(*args)
+
+        p = SpyParser()
+        r1 = p.load(fs_path, track=True)
+        self.assertDictEqual(r1, conff.Parser().load(fs_path))
+        data, changed = p.reload()
+        self.assertIs(data, r1)
+        self.assertListEqual(changed, [])
+        with open(fs_path) as stream:
+            text = stream.read()
+        with open(fs_path, 'w') as stream:
+            stream.write(text.replace('port: 80', 'port: 8080'))
+        del calls[:]
+        data, changed = p.reload()
+        self.assertListEqual(changed, ['ext', 'port', 'shared.port'])
+        self.assertDictEqual(data, conff.Parser().load(fs_path))
+        self.assertListEqual(calls, [])
+        with open(self.get_test_data_path('test_config_01.yml'), 'w') as stream:
+            stream.write('test_1: changed\n')
+        data, changed = p.reload()
+        self.assertListEqual(changed, ['inc'])
+        self.assertDictEqual(data['inc'], {'test_1': 'changed'})
+        self.assertEqual(len(calls), 1)
+
+    def test_eval_order(self):
+        fs_path = self.get_test_data_path('test_config_10.yml')
+        p = conff.Parser(params={'eval_order': 'dependency'})
+        data = p.load(fs_path)
+        self.assertDictEqual(data, {'test_1': 2, 'test_2': {'test_2_1': 4, 'test_2_2': 11}, 'test_3': 1,
+                                    'test_4': {'test_5_1': 1, 'test_5_2': 2, 'test_4_1': 11},
+                                    'test_5': {'test_5_1': 1, 'test_5_2': 2}})
+        self.assertListEqual(p.plan(utils.odict([('a', 'R.b'), ('b', 1)])), [('b',), ('a',)])
+        data = p.parse(utils.odict([('a', 'b + 1'), ('b', '1 + 1')]))
+        self.assertDictEqual(data, {'a': 3, 'b': 2})
+        # same result as document order when there is no reference to values defined later
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        for name in ('test_config_04.yml', 'sample_config_03.yml'):
+            fs_path = self.get_test_data_path(name)
+            r1 = conff.Parser(params={'ekey': ekey}).load(fs_path)
+            r2 = conff.Parser(params={'ekey': ekey, 'eval_order': 'dependency'}).load(fs_path)
+            self.assertDictEqual(r1, r2)
+
+    def test_error_eval_order(self):
+        p = conff.Parser(params={'eval_order': 'dependency'})
+        fs_path = self.get_test_data_path('malformed_ref_01.yml')
+        with self.assertRaises(ValueError) as context:
+            p.load(fs_path=fs_path)
+        self.assertEqual(str(context.exception), 'Circular reference: test_1 -> test_2.test_2_1 -> test_1')
+
+    def test_copy_tree(self):
+        base = utils.odict([('a', {'b': {'c': 1}}), ('d', [{'e': 1}]), ('f', 1)])
+        p = conff.Parser()
+        data = p.fn_extend(base, {'g': 2})
+        self.assertDictEqual(data, {'a': {'b': {'c': 1}}, 'd': [{'e': 1}], 'f': 1, 'g': 2})
+        self.assertIsInstance(data, utils.odict)
+        self.assertListEqual(list(data), ['a', 'd', 'f', 'g'])
+        data['a']['b']['c'] = 2
+        data['d'][0]['e'] = 2
+        self.assertDictEqual(base, {'a': {'b': {'c': 1}}, 'd': [{'e': 1}], 'f': 1})
+        # changing the base afterwards does not leak into the extended node either
+        fs_path = self.get_test_data_path('extend.yml')
+        with open(fs_path, 'w') as stream:
+            stream.write('base:\n  a:\n    b: 1\next:\n  F.extend: R.base\n  z: 1\n')
+        r = p.load(fs_path)
+        r['base']['a']['b'] = 99
+        self.assertEqual(r['ext']['a']['b'], 1)
+        # nor evaluating a base defined later
+        with open(fs_path, 'w') as stream:
+            stream.write('ext:\n  F.extend: R.base\n  z: 1\nbase:\n  a:\n    b: 1 + 1\n')
+        r = p.load(fs_path)
+        self.assertEqual(r['ext']['a']['b'], '1 + 1')
+        self.assertEqual(r['base']['a']['b'], 2)
+        # nor into the cached F.inc result
+        with open(self.get_test_data_path('nested.yml'), 'w') as stream:
+            yaml.safe_dump({'a': {'b': 1}}, stream)
+        p = conff.Parser(params={'fs_root': self.test_data_path})
+        p.includes = {}
+        p.fn_inc('nested.yml')['a']['b'] = 2
+        p.fn_inc('nested.yml')['a']['b'] = 3
+        self.assertEqual(p.fn_inc('nested.yml'), {'a': {'b': 1}})
+        # template with nested values is evaluated on every loop
+        data = p.parse(utils.odict([('F.foreach', {'values': [1, 2], 'template': {
+            '"t%i" % loop.index': {'a': {'b': 'loop.value'}}}})]))
+        self.assertDictEqual(data, {'t0': {'a': {'b': 1}}, 't1': {'a': {'b': 2}}})
+        self.assertIsInstance(data['t0']['a'], utils.odict)
+        self.assertDictEqual(utils.copy_tree(base), copy.deepcopy(base))
+
+    def test_template_cache(self):
+        p = conff.Parser(names={'a': 1})
+        info = conff.Parser.template_cache.info()
+        self.assertEqual(p.parse('F.template("{{ a + 2 }}")'), '3')
+        self.assertEqual(p.parse('F.template("{{ a + 2 }}")'), '3')
+        self.assertEqual(conff.Parser.template_cache.info()['hits'], info['hits'] + 1)
+        self.assertEqual(p.template_stats['parse'], 0)
+        self.assertDictEqual(p.fn_template('b: {{ a }}', {'c': 2}), {'c': 2, 'b': 1})
+        self.assertEqual(p.template_stats['count'], 3)
+        self.assertGreater(p.template_stats['parse'], 0)
+        # native mode keeps the rendered python value, no YAML parsing
+        p = conff.Parser(names={'a': 1}, params={'template_mode': 'native'})
+        self.assertEqual(p.parse('F.template("{{ a + 2 }}")'), 3)
+        self.assertDictEqual(p.fn_template("{{ {'b': a} }}", {'c': 2}), {'c': 2, 'b': 1})
+        self.assertEqual(p.template_stats['parse'], 0)
+
+    def test_range(self):
+        p = conff.Parser(params={'range_output': 'lazy'})
+        data = p.fn_arange(0, 1, 0.1)
+        self.assertIsInstance(data, utils.LinearRange)
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data[-1], 1.0)
+        self.assertEqual(p.fn_linspace(0, 10, 5), [0.0, 2.5, 5.0, 7.5, 10.0])
+        self.assertEqual(len(p.fn_arange(0, 10 ** 9, 1)), 10 ** 9 + 1)
+        self.assertEqual(p.parse('F.next(F.linspace(0, 10, 3))'), 0.0)
+        with self.assertRaises(ValueError):
+            p.fn_arange(0, 1, 0)
+        p = conff.Parser()
+        self.assertEqual(type(p.fn_arange(0, 6, 3)), list)
+        self.assertEqual(p.fn_arange(0, 6, 3), [0, 3, 6])
+        self.assertEqual(p.parse('F.next(F.linspace(0, 10, 3))'), 0.0)
+        # stored ranges are plain lists, F.foreach values stay lazy
+        fs_path = self.get_test_data_path('range.yml')
+        with open(fs_path, 'w') as stream:
+            yaml.safe_dump({'y': 'F.linspace(0, 1, 3)', 'z': 'R.y + [5]', 'w': {'F.foreach': {
+                'values': 'F.arange(0, 2, 1)', 'template': {'"k_%i" % loop.index': 'loop.value'}}}}, stream,
+                sort_keys=False)
+        data = p.load(fs_path)
+        self.assertEqual(data['z'], [0.0, 0.5, 1.0, 5])
+        self.assertEqual(json.dumps(data),
+                         '{"y": [0.0, 0.5, 1.0], "z": [0.0, 0.5, 1.0, 5], "w": {"k_0": 0, "k_1": 1, "k_2": 2}}')
+        self.assertFalse(p._lazy_range)
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_range_numpy(self):
+        p = conff.Parser(params={'range_output': 'numpy'})
+        data = p.fn_arange(0, 1, 0.1)
+        self.assertEqual(len(data), 11)
+        self.assertEqual(data.tolist(), list(utils.LinearRange(0, 0.1, 11)))
+
+    def test_encryption_many(self):
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        p = conff.Parser(params={'ekey': ekey})
+        values = ['secret_{}'.format(i) for i in range(20)]
+        tokens = p.encrypt_many(values, workers=4)
+        self.assertEqual(p.decrypt_many(tokens), values)
+        self.assertIs(utils.get_cipher(ekey), utils.get_cipher(ekey))
+        # decrypted upfront by the workers, same result
+        fs_path = self.get_test_data_path('sample_config_02.yml')
+        r1 = conff.Parser(params={'ekey': ekey}).load(fs_path)
+        r2 = conff.Parser(params={'ekey': ekey}, workers=2).load(fs_path)
+        self.assertDictEqual(r1, r2)
+
+    def test_encryption_rotate(self):
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        new_ekey = conff.Parser().generate_crypto_key()
+        fs_path = self.get_test_data_path('sample_config_02.yml')
+        r1 = conff.Parser(params={'ekey': ekey}).load(fs_path)
+        p = conff.Parser(params={'ekey': [new_ekey, ekey]})
+        data = p.rotate_secrets(p.read_file(fs_path))
+        tokens = p.find_secrets(data)
+        self.assertEqual(len(tokens), 1)
+        self.assertNotIn(tokens[0], p.find_secrets(p.read_file(fs_path)))
+        # only the new key is needed for the rotated tokens
+        p = conff.Parser(params={'ekey': new_ekey})
+        self.assertDictEqual(p.parse(data)['shared'], r1['shared'])
+
+    def test_evaluator_options(self):
+        import simpleeval
+        max_power = simpleeval.MAX_POWER
+        p1 = conff.Parser(params={'simpleeval': {'options': {'max_power': 2}}})
+        p2 = conff.Parser()
+        self.assertEqual(simpleeval.MAX_POWER, max_power)
+        self.assertEqual(p2.parse('3 ** 3'), 27)
+        self.assertEqual(p1.parse('3 ** 3'), '3 ** 3')
+        self.assertIsInstance(p1.errors[0], simpleeval.NumberTooHigh)
+        self.assertIs(type(p1.evaluator),
+                      type(conff.Parser(params={'simpleeval': {'options': {'max_power': 2}}}).evaluator))
+        # user given simpleeval operators apply the options too
+        import ast
+        p3 = conff.Parser(params={'simpleeval': {'operators': {ast.Pow: simpleeval.safe_power},
+                                                 'options': {'max_power': 2}}})
+        self.assertEqual(p3.parse('2 ** 10'), '2 ** 10')
+        self.assertIsInstance(p3.errors[0], simpleeval.NumberTooHigh)
+        self.assertEqual(simpleeval.MAX_POWER, max_power)
+
+    def test_clone(self):
+        fs_path = self.get_test_data_path('test_config_01.yml')
+        # nested default params are shared and immutable, only the overridden ones are copied
+        p1, p2 = conff.Parser(), conff.Parser(params={'diagnostics': {'maxsize': 5}})
+        self.assertIs(p1.params['simpleeval'], p2.params['simpleeval'])
+        self.assertEqual(p2.params['diagnostics'], {'maxsize': 5, 'sample': 1, 'severity': 'info'})
+        self.assertEqual(p1.params['diagnostics']['maxsize'], 1000)
+        with self.assertRaises(TypeError):
+            p1.params['simpleeval']['options']['max_power'] = 1
+        p = conff.Parser(names={'a': 1}, fns={'add': lambda x, y: x + y})
+        r1 = p.load(fs_path)
+        p2 = p.clone()
+        self.assertDictEqual(p2.load(fs_path), r1)
+        self.assertEqual(p2.parse('F.add(a, 1)'), 2)
+        self.assertIs(p2.fns['F']['inc'].__self__, p2)
+        self.assertIsNot(p2.names, p.names)
+        pool = conff.parser.ParserPool(p, maxsize=1)
+        with pool.parser() as p3:
+            p3.parse('F.no_exist()')
+            self.assertEqual(len(p3.errors), 1)
+        with pool.parser() as p4:
+            self.assertIs(p4, p3)
+            self.assertEqual(p4.errors, [])
+            self.assertDictEqual(p4.load(fs_path), r1)
+
+    def test_threads(self):
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        names = ['test_config_01.yml', 'test_config_02.yml', 'test_config_05.yml', 'test_config_06.yml',
+                 'sample_config_03.yml']
+        fs_paths = [self.get_test_data_path(name) for name in names]
+        foreach = utils.odict([('F.foreach', {'values': 'F.arange(0, 20, 1)', 'template': {
+            '"t%i" % loop.index': {'a': 'loop.value * 2', 'b': 'x'}}})])
+        expected = [conff.Parser(names={'test': 1}, params={'ekey': ekey}).load(fs_path) for fs_path in fs_paths]
+        p = conff.Parser(names={'test': 1, 'x': 'x'}, params={'ekey': ekey})
+        data_foreach = p.parse(foreach)
+
+        def work(i):
+            results = []
+            for _ in range(10):
+                results.append(p.load(fs_paths[i % len(fs_paths)]))
+                results.append(p.parse(foreach))
+            return results
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            for i, results in enumerate(pool.map(work, range(16))):
+                for j in range(0, len(results), 2):
+                    self.assertDictEqual(results[j], expected[i % len(fs_paths)])
+                    self.assertDictEqual(results[j + 1], data_foreach)
+        self.assertNotIn('loop', p.names)
+        self.assertNotIn('fs_root', p.params)
+        # files are the ones of the last call, finished calls give their evaluator back
+        self.assertListEqual(p.files, [])
+        p.load(fs_paths[0])
+        p.load(fs_paths[0])
+        self.assertListEqual(p.files, [fs_paths[0]])
+        self.assertLessEqual(len(p._evaluators), 8)
+
+    def test_aload(self):
+        import asyncio
+        ekey = 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='
+        loop = asyncio.new_event_loop()
+        try:
+            for name in ('test_config_01.yml', 'test_config_05.yml', 'test_config_06.yml', 'sample_config_03.yml'):
+                fs_path = self.get_test_data_path(name)
+                p1 = conff.Parser(names={'test': 1}, params={'ekey': ekey})
+                p2 = conff.Parser(names={'test': 1}, params={'ekey': ekey})
+                r1 = p1.load(fs_path)
+                r2 = loop.run_until_complete(p2.aload(fs_path))
+                self.assertDictEqual(r1, r2)
+                self.assertListEqual(p1.files, p2.files)
+                self.assertEqual(len(p1.errors), len(p2.errors))
+            # many loads at once on the same parser
+            fs_path = self.get_test_data_path('test_config_06.yml')
+            r1 = conff.Parser().load(fs_path)
+            p = conff.Parser()
+
+            async def gather():
+                return await asyncio.gather(*(p.aload(fs_path) for _ in range(8)))
+
+            results = loop.run_until_complete(gather())
+            for r2 in results:
+                self.assertDictEqual(r1, r2)
+        finally:
+            loop.close()
+
+    def test_benchmark(self):
+        from conff import benchmark
+        results = benchmark.bench_config(size=4, repeat=1)
+        self.assertListEqual([r['name'] for r in results], list(benchmark.GENERATORS))
+        for r in results:
+            self.assertGreater(r['leaves'], 0)
+            self.assertGreater(r['peak_memory'], 0)
+        self.assertEqual(results[2]['leaves'], 8)
+        baseline = [dict(r, load=r['load'] / 2) for r in results]
+        self.assertTrue(all(regressed for *_, regressed in benchmark.compare(results, baseline)))
+
+    def test_lazy_imports(self):
+        from conff import benchmark
+        r = benchmark.bench_import(size=4, repeat=1)
+        self.assertListEqual(r['modules'], [])
+        self.assertGreater(r['import'], 0)
+        # heavy dependencies still load on use
+        p = conff.Parser(params={'template_mode': 'native'})
+        self.assertEqual(p.parse('F.template("{{ 1 + 1 }}")'), 2)
+        self.assertIs(conff.Parser.get_template_env('native'), conff.Parser.template_envs['native'])
+        self.assertTrue(p.generate_crypto_key())
+        self.assertEqual(p.fn_decrypt(p.fn_encrypt('secret')), 'secret')
+
+    def test_profiler(self):
+        from conff.profiler import Profiler
+        events = []
+        profiler = Profiler(hooks=[events.append])
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        params = {'ekey': 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='}
+        r1 = conff.Parser(params=params).load(fs_path)
+        p = conff.Parser(params=params, profiler=profiler)
+        self.assertDictEqual(p.load(fs_path), r1)
+        report = profiler.report()
+        directives = {e['name']: e for e in report['directives']}
+        self.assertEqual(directives['F.inc']['count'], 1)
+        self.assertEqual(directives['F.inc']['nodes'], 2)
+        self.assertEqual(directives['F.foreach']['count'], 3)
+        paths = {(os.path.basename(e['file']), e['path']): e for e in report['paths']}
+        self.assertEqual(paths[('test_config_02.yml', 'test_12')]['nodes'], 2)
+        self.assertIn(('test_config_01.yml', 'test_1'), paths)
+        self.assertGreaterEqual(paths[('test_config_02.yml', '')]['seconds'], report['files'][0]['seconds'])
+        self.assertEqual(len(events), sum(e['count'] for e in report['paths'] + report['directives']))
+        self.assertSetEqual(set(events[0]), {'kind', 'name', 'file', 'path', 'seconds', 'nodes'})
+        # the copy of the parser records into the same profiler, a parser without profiler is untouched
+        p.clone().parse('F.str(1)')
+        directives = {e['name']: e for e in profiler.report()['directives']}
+        self.assertEqual(directives['F.str']['count'], 2)
+        self.assertNotIn('_process', vars(conff.Parser()))
+        # nested function namespaces give the same result with a profiler
+        p = conff.Parser(fns={'ns': {'double': lambda x: x * 2}}, profiler=profiler)
+        self.assertEqual(p.parse('F.ns.double(2)'), 4)
+        self.assertEqual(p.errors, [])
+        directives = {e['name']: e for e in profiler.report()['directives']}
+        self.assertEqual(directives['F.ns.double']['count'], 1)
+
+    def test_diagnostics(self):
+        import simpleeval
+        data = utils.odict([('a', {'b': ['F.nope()', 'x y', 'F.nope2()']}), ('c', 'F.nope3()')])
+        p = conff.Parser()
+        p.parse(copy.deepcopy(data))
+        self.assertEqual(len(p.errors), 4)
+        self.assertIsInstance(p.errors[0], simpleeval.AttributeDoesNotExist)
+        self.assertListEqual([(r.severity, r.path) for r in p.errors.records], [
+            ('warning', ('a', 'b', 0)), ('info', ('a', 'b', 1)), ('warning', ('a', 'b', 2)), ('warning', ('c',))])
+        self.assertEqual(p.errors.records[3].expression, 'F.nope3()')
+        self.assertIsNone(p.errors[0].__traceback__)
+        # bounded: only warnings, one of every two per error class, at most 1 of them
+        p = conff.Parser(params={'diagnostics': {'maxsize': 1, 'sample': 2, 'severity': 'warning'}})
+        p.parse(copy.deepcopy(data))
+        self.assertEqual(len(p.errors), 1)
+        self.assertDictEqual(p.errors.summary(), {
+            'total': 4, 'stored': 1, 'dropped': 3, 'categories': {'AttributeDoesNotExist': 3, 'SyntaxError': 1},
+            'severities': {'info': 1, 'warning': 3, 'error': 0}})
+        # location is the file and the config path of the value
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        p = conff.Parser(params={'ekey': 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='})
+        p.load(fs_path)
+        self.assertIn(fs_path + ':test_10', [r.location for r in p.errors.records])
+        # errors reset with a plain list are still collected by the shared context paths
+        p.errors = []
+        self.assertIsInstance(p.errors, diagnostics.Diagnostics)
+        data = p.load(fs_path, lazy=True)
+        data.get('test_10')
+        self.assertEqual(len(p.errors), 1)
+        p.errors = []
+        with open(self.get_test_data_path('errors.yml'), 'w') as stream:
+            stream.write('a: F.nope()\n---\nb: 1\n')
+        self.assertEqual(list(p.iter_load(self.get_test_data_path('errors.yml'))), [{'a': 'F.nope()'}, {'b': 1}])
+        self.assertIsInstance(p.errors[0], simpleeval.AttributeDoesNotExist)
+
+    def test_freeze(self):
+        import pickle
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        params = {'ekey': 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='}
+        r1 = conff.Parser(params=params).load(fs_path)
+        r2 = conff.Parser(params=dict(params, freeze=True)).load(fs_path)
+        self.assertIsInstance(r2, utils.FrozenMunch)
+        self.assertEqual(r2, r1)
+        self.assertListEqual(list(r2), list(r1))
+        self.assertEqual(r2.test_12.test_1, 'test_1')
+        self.assertIsInstance(r2.test_3, tuple)
+        self.assertEqual(r2.lookup('test_12.test_1'), 'test_1')
+        self.assertEqual(r2.lookup(('test_3', 0)), r1['test_3'][0])
+        self.assertIsNone(r2.lookup('test_12.no_exist'))
+        with self.assertRaises(TypeError):
+            r2['test_1'] = 1
+        with self.assertRaises(TypeError):
+            r2.test_1 = 1
+        self.assertEqual(hash(r2), hash(conff.Parser(params=dict(params, freeze=True)).load(fs_path)))
+        self.assertEqual(pickle.loads(pickle.dumps(r2)), r2)
+        self.assertDictEqual(utils.thaw(r2), r1)
+        # keys and strings are interned, nodes with the same keys share them
+        r3 = utils.freeze([{'name': 'a' * 50}, {'name': 'a' * 50}])
+        self.assertIs(r3[0].name, r3[1].name)
+        self.assertIs(r3[0]._keys, r3[1]._keys)
+        self.assertEqual(conff.Parser(params={'freeze': True}).parse(utils.odict([('a', [1, '1 + 1'])])).a, (1, 2))
+        shared = {'b': [1]}
+        r4 = utils.freeze({'a': shared, 'c': shared})
+        self.assertIs(r4.a, r4.c)
+        self.assertEqual(r4.lookup('c.b.0'), 1)
+        cycle = [1]
+        cycle.append(cycle)
+        with self.assertRaises(ValueError):
+            utils.freeze(cycle)
+        # any sequence is frozen into a tuple, other mutable values are refused
+        p = conff.Parser(params={'freeze': True, 'range_output': 'lazy'})
+        r5 = p.parse(utils.odict([('a', 'F.arange(0, 2, 1)')]))
+        self.assertEqual(r5.a, (0, 1, 2))
+        self.assertEqual(hash(r5), hash(utils.freeze({'a': [0, 1, 2]})))
+        with self.assertRaises(TypeError) as context:
+            utils.freeze({'a': {'b': bytearray(b'b')}})
+        self.assertEqual(str(context.exception), 'Cannot freeze mutable value of type bytearray at a.b')
+
+    def test_snapshot(self):
+        import datetime
+        from conff import snapshot
+        fs_path = self.get_test_data_path('test_config_02.yml')
+        r1 = conff.Parser(params={'ekey': 'FOb7DBRftamqsyRFIaP01q57ZLZZV6MVB2xg1Cg_E7g='}).load(fs_path)
+        r1['extra'] = utils.odict([(1, 2 ** 70), ('date', datetime.date(2020, 1, 1)), ('none', None), ('empty', {})])
+        snapshot_path = self.get_test_data_path('config.snapshot')
+        snapshot.dump(r1, snapshot_path)
+        r2 = snapshot.attach(snapshot_path)
+        self.assertEqual(r2, r1)
+        self.assertListEqual(list(r2), list(r1))
+        self.assertEqual(r2.test_12.test_1, 'test_1')
+        self.assertEqual(r2.extra[True], 2 ** 70)
+        self.assertEqual(r2.extra.date, datetime.date(2020, 1, 1))
+        self.assertNotIn('no_exist', r2)
+        self.assertDictEqual(snapshot.to_python(r2), r1)
+        with self.assertRaises(TypeError):
+            r2.test_1 = 1
+        with self.assertRaises(TypeError):
+            r2.test_3._count = 0
+        with snapshot.Snapshot(snapshot_path) as s:
+            self.assertEqual(s.lookup('test_12.test_1'), 'test_1')
+            self.assertEqual(s.lookup(('test_3', 0)), r1['test_3'][0])
+            self.assertIsNone(s.lookup('test_12.no_exist'))
+        with open(snapshot_path, 'wb') as stream:
+            stream.write(b'not a snapshot file')
+        with self.assertRaises(ValueError):
+            snapshot.attach(snapshot_path)
+
+    def test_load_layers(self):
+        layers = {
+            'base.yml': {'app': {'name': 'app', 'port': 80, 'hosts': ['a', 'b'], 'db': {'host': 'db', 'pool': 4}},
+                         'debug': False},
+            'region.yml': {'app': {'hosts': ['b', 'c'], 'db': {'host': 'R.region + "-db"'}}, 'region': 'eu'},
+            'env.yml': {'app': {'port': 8080, 'db': {'pool': 'F.int("8")'}}, 'debug': True},
+        }
+        for fs_path, data in layers.items():
+            with open(self.get_test_data_path(fs_path), 'w') as stream:
+                yaml.safe_dump(data, stream, default_flow_style=False, sort_keys=False)
+        p = conff.Parser()
+        r, provenance = p.load_layers(list(layers), fs_root=self.test_data_path)
+        self.assertDictEqual(r, {'app': {'name': 'app', 'port': 8080, 'hosts': ['b', 'c'],
+                                         'db': {'host': 'eu-db', 'pool': 8}},
+                                 'debug': True, 'region': 'eu'})
+        self.assertListEqual(list(r['app']), ['name', 'port', 'hosts', 'db'])
+        self.assertEqual(provenance.origin('app.name'), 'base.yml')
+        self.assertEqual(provenance.origin('app.db.host'), 'region.yml')
+        self.assertEqual(provenance.origin(('app', 'db', 'pool')), 'env.yml')
+        self.assertEqual(provenance.origin('app.hosts.0'), 'region.yml')
+        r, provenance = p.load_layers(list(layers), fs_root=self.test_data_path, list_strategy='unique')
+        self.assertListEqual(r['app']['hosts'], ['a', 'b', 'c'])
+        self.assertEqual(provenance.origin('app.hosts.0'), 'base.yml')
+        self.assertEqual(provenance.origin('app.hosts.2'), 'region.yml')
+        r, _ = p.load_layers(list(layers)[:2], fs_root=self.test_data_path, list_strategy='append')
+        self.assertListEqual(r['app']['hosts'], ['a', 'b', 'b', 'c'])
+        with self.assertRaises(ValueError):
+            p.load_layers(list(layers), fs_root=self.test_data_path, list_strategy='no_exist')
+        self.assertEqual(utils.merge_layer({'a': {'b': 1}}, {'a': {'c': 2}}, 1), {'a': {'b': 1, 'c': 2}})
+
+    def test_foreach_plan(self):
+        def foreach(values):
+            return utils.odict([('base', {'q': [1, 2]}), ('top', {'F.foreach': {'values': values, 'template': {
+                '"k_%i" % loop.index': {'v': 'loop.value * 2', 'c': '2 ** 3', 'ref': 'base', 'lst': ['s', 'loop.index'],
+                                        'ext': {'F.extend': 'base', 'z': 'loop.length'}, 'text': 'x y'}}}})])
+
+        p = conff.Parser()
+        r = p.parse(foreach([1, 2, 3]))['top']
+        self.assertDictEqual(r['k_1'], {'v': 4, 'c': 8, 'ref': {'q': [1, 2]}, 'lst': ['s', 1],
+                                        'ext': {'q': [1, 2], 'z': 3}, 'text': 'x y'})
+        # items never share containers
+        r['k_0']['ref']['q'].append(3)
+        r['k_0']['lst'].append(3)
+        self.assertDictEqual(r['k_2']['ref'], {'q': [1, 2]})
+        self.assertListEqual(r['k_2']['lst'], ['s', 2])
+        # static error is reported once at the template, the others at the item
+        paths = [r.path for r in p.errors.records if r.category == 'SyntaxError']
+        self.assertEqual(paths[-1], ('top', 'F.foreach', 'template', '"k_%i" % loop.index', 'text'))
+        for p in (conff.Parser(), conff.Parser(params={'foreach_chunk': 2}, workers=2)):
+            p.parse(utils.odict([('top', {'F.foreach': {'values': [1, 2, 3], 'template': {
+                '"k_%i" % loop.index': 'loop.value + nope'}}})]))
+            self.assertListEqual([r.path for r in p.errors.records][-3:],
+                                 [('top', 'k_0'), ('top', 'k_1'), ('top', 'k_2')])
+        # chunks in parallel give the same result
+        p = conff.Parser(params={'foreach_chunk': 2}, workers=3)
+        self.assertDictEqual(p.parse(foreach([1, 2, 3]))['top'], conff.Parser().parse(foreach([1, 2, 3]))['top'])
+        self.assertDictEqual(p.parse(foreach([]))['top'], {})
+        # loop of the outer F.foreach is back after the inner one
+        r = conff.Parser().parse(utils.odict([('top', {'F.foreach': {'values': [1, 2], 'template': {
+            '"o_%i" % loop.index': {'F.foreach': {'values': [10], 'template': {'"i"': 'loop.value'}}},
+            '"p_%i" % loop.index': 'loop.value'}}})]))
+        self.assertDictEqual(r['top'], {'o_0': {'i': 10}, 'p_0': 1, 'o_1': {'i': 10}, 'p_1': 2})
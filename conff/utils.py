@@ -1,5 +1,13 @@
+import copy
+import functools
+import sys
+import threading
 from munch import Munch
 from collections import OrderedDict as odict
+from collections.abc import ItemsView, KeysView, Mapping, Sequence, ValuesView
+
+# marker of missing value, where None is a valid value
+_missing = object()
 
 
 class Munch2(Munch):
@@ -15,6 +23,398 @@ class Munch2(Munch):
     pass
 
 
+class LazyMunch(Munch2):
+    """
+    Munch2 which resolves each value on the first access and keeps the result.
+    The resolver is called with the raw value, it should return nested dict
+    as LazyMunch to keep it lazy. Copying or pickling resolves everything into
+    plain OrderedDict.
+    """
+
+    def __init__(self, data=None, resolver=None):
+        object.__setattr__(self, '_resolver', resolver)
+        object.__setattr__(self, '_resolved', set())
+        object.__setattr__(self, '_resolving', set())
+        dict.update(self, data or {})
+
+    def __getitem__(self, k):
+        value = dict.__getitem__(self, k)
+        if k in self._resolved:
+            return value
+        if k in self._resolving:
+            raise ValueError('Circular reference while resolving: {}'.format(k))
+        self._resolving.add(k)
+        try:
+            value = self._resolver(value)
+        finally:
+            self._resolving.discard(k)
+        dict.__setitem__(self, k, value)
+        self._resolved.add(k)
+        return value
+
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        self._resolved.add(k)
+
+    def __iter__(self):
+        # overridden, so dict(self) and ** unpacking read values via __getitem__
+        return dict.__iter__(self)
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def copy(self):
+        return Munch2(self.items())
+
+    def __eq__(self, other):
+        return self.toDict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __deepcopy__(self, memo):
+        return odict((k, copy.deepcopy(v, memo)) for k, v in self.items())
+
+    def __reduce__(self):
+        return odict, (list(self.items()),)
+
+
+# leaves which are shared by copy_tree, nothing could change them in place
+IMMUTABLE_TYPES = frozenset([str, int, float, bool, bytes, type(None)])
+
+
+def copy_tree(value):
+    """
+    Same result as copy.deepcopy for nested dict, OrderedDict and list, the
+    containers are copied with their type and immutable leaves are shared
+    without the memo and reduce protocol of deepcopy. Anything else is
+    deep copied.
+    """
+    value_type = type(value)
+    if value_type == odict or value_type == dict:
+        return value_type((k, v if type(v) in IMMUTABLE_TYPES else copy_tree(v)) for k, v in value.items())
+    if value_type == list:
+        return [v if type(v) in IMMUTABLE_TYPES else copy_tree(v) for v in value]
+    if value_type in IMMUTABLE_TYPES:
+        return value
+    return copy.deepcopy(value)
+
+
+class FrozenMunch(Mapping):
+    """
+    Immutable and hashable mapping with dot-access like Munch2. Keys and values
+    are kept in tuples, nodes with the same keys share one key index, so it is
+    much smaller than OrderedDict. Root built by freeze also has an index of
+    every path for lookup.
+    """
+    __slots__ = ('_keys', '_values', '_index', '_paths', '_hash')
+
+    def __init__(self, data=(), _shape=None):
+        items = list(data.items() if isinstance(data, Mapping) else data)
+        keys, values = zip(*items) if items else ((), ())
+        keys, index = _shape or (tuple(keys), {k: i for i, k in enumerate(keys)})
+        object.__setattr__(self, '_keys', keys)
+        object.__setattr__(self, '_values', tuple(values))
+        object.__setattr__(self, '_index', index)
+        object.__setattr__(self, '_paths', None)
+        object.__setattr__(self, '_hash', None)
+
+    def __getitem__(self, k):
+        return self._values[self._index[k]]
+
+    def __getattr__(self, k):
+        if k in FrozenMunch.__slots__:
+            # not initialised yet e.g. while unpickling
+            raise AttributeError(k)
+        try:
+            return self._values[self._index[k]]
+        except KeyError:
+            raise AttributeError(k)
+
+    def __setattr__(self, k, v):
+        raise TypeError('{} is immutable'.format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, k):
+        return k in self._index
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for k, v in zip(self._keys, self._values):
+            if k not in other or not _frozen_equal(v, other[k]):
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        if self._hash is None:
+            # equal regardless of the key order, so is the hash
+            object.__setattr__(self, '_hash', hash(frozenset(zip(self._keys, self._values))))
+        return self._hash
+
+    def __repr__(self):
+        return '{}({{{}}})'.format(type(self).__name__, ', '.join('{!r}: {!r}'.format(k, v) for k, v in self.items()))
+
+    def __reduce__(self):
+        return type(self), (list(zip(self._keys, self._values)),)
+
+    def __dir__(self):
+        return list(self._keys)
+
+    def lookup(self, path, default=None):
+        """
+        Value at the path in O(1), path is dotted string e.g. "a.b.0" or tuple
+        of keys, only for the root built by freeze(..., index=True)
+        """
+        if self._paths is None:
+            raise ValueError('Path index is not built, use freeze(..., index=True)')
+        if not isinstance(path, str):
+            path = '.'.join(str(k) for k in path)
+        # only dict and list are indexed, the last key of a scalar is looked up in its parent
+        value = self._paths.get(path, _missing)
+        if value is not _missing:
+            return value
+        parent, _, key = path.rpartition('.')
+        parent = self._paths.get(parent, _missing)
+        if isinstance(parent, FrozenMunch):
+            for k in parent._keys:
+                if str(k) == key:
+                    return parent[k]
+        elif isinstance(parent, tuple) and key.lstrip('-').isdigit():
+            try:
+                return parent[int(key)]
+            except IndexError:
+                pass
+        return default
+
+    def toDict(self):
+        return odict((k, thaw(v)) for k, v in self.items())
+
+
+def _frozen_equal(a, b):
+    if isinstance(a, tuple) and isinstance(b, list):
+        return len(a) == len(b) and all(_frozen_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def freeze(value, index: bool = True):
+    """
+    Immutable copy of nested mappings and sequences as FrozenMunch and tuple,
+    keys and strings are interned, so repeated ones are stored once. Raises
+    TypeError on other unhashable values.
+
+    :param index: Build the index of every path into the root FrozenMunch for lookup
+    """
+    paths = {} if index else None
+    result = _freeze(value, {}, {}, paths, '')
+    if paths is not None and isinstance(result, FrozenMunch):
+        object.__setattr__(result, '_paths', paths)
+    return result
+
+
+def _freeze(value, memo: dict, shapes: dict, paths: dict, prefix: str):
+    if isinstance(value, Mapping) or (isinstance(value, Sequence) and not isinstance(value, (str, bytes, bytearray))):
+        # value referred from many places (e.g. by R) is frozen once and shared
+        frozen = memo.get(id(value))
+        if frozen is _missing:
+            raise ValueError('Circular reference while freezing: {}'.format(prefix))
+        if frozen is not None:
+            if paths is not None:
+                _index_paths(frozen, paths, prefix)
+            return frozen
+        memo[id(value)] = _missing
+    else:
+        if isinstance(value, (set, frozenset)):
+            return frozenset(_freeze(v, memo, shapes, None, '') for v in value)
+        if type(value) == str:
+            return sys.intern(value)
+        if type(value).__hash__ is None:
+            # e.g. bytearray or numpy array, the result would be neither immutable nor hashable
+            raise TypeError('Cannot freeze mutable value of type {}{}'.format(
+                type(value).__name__, ' at {}'.format(prefix) if prefix else ''))
+        return value
+    if isinstance(value, Mapping):
+        items = [(sys.intern(k) if type(k) == str else k, v) for k, v in value.items()]
+        keys = tuple(k for k, _ in items)
+        # nodes with the same keys share the key tuple and the key index
+        shape = shapes.get(keys)
+        if shape is None:
+            shape = shapes[keys] = (keys, {k: i for i, k in enumerate(keys)})
+        if paths is None:
+            values = [_freeze(v, memo, shapes, None, '') for _, v in items]
+        else:
+            values = [_freeze(v, memo, shapes, paths, '{}.{}'.format(prefix, k) if prefix else str(k))
+                      for k, v in items]
+        frozen = FrozenMunch(zip(keys, values), _shape=shape)
+    else:
+        if paths is None:
+            frozen = tuple(_freeze(v, memo, shapes, None, '') for v in value)
+        else:
+            frozen = tuple(_freeze(v, memo, shapes, paths, '{}.{}'.format(prefix, i) if prefix else str(i))
+                           for i, v in enumerate(value))
+    memo[id(value)] = frozen
+    if paths is not None:
+        paths[prefix] = frozen
+    return frozen
+
+
+def _index_paths(value, paths: dict, prefix: str):
+    if isinstance(value, FrozenMunch):
+        items = value.items()
+    elif isinstance(value, tuple):
+        items = enumerate(value)
+    else:
+        return
+    paths[prefix] = value
+    for k, v in items:
+        _index_paths(v, paths, '{}.{}'.format(prefix, k) if prefix else str(k))
+
+
+def thaw(value):
+    """
+    Mutable copy of the value built by freeze
+    """
+    if isinstance(value, FrozenMunch):
+        return value.toDict()
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class LinearRange(Sequence):
+    """
+    Lazy sequence of start + step * i for i in range(count). Values are computed
+    on access, so a big range costs nothing until it is iterated. It compares
+    equal to list or tuple with the same values.
+    """
+    __slots__ = ('start', 'step', 'count')
+
+    def __init__(self, start, step, count: int):
+        self.start = start
+        self.step = step
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(self.count)[i]]
+        return self.start + self.step * range(self.count)[i]
+
+    def __iter__(self):
+        start, step = self.start, self.step
+        for i in range(self.count):
+            yield start + step * i
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, LinearRange)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}(start={!r}, step={!r}, count={!r})'.format(type(self).__name__, self.start, self.step, self.count)
+
+    def tolist(self):
+        return list(self)
+
+    def toarray(self):
+        """
+        Materialise as numpy array in bulk, requires numpy
+        """
+        import numpy
+        return numpy.arange(self.count) * self.step + self.start
+
+
+class LRUCache(object):
+    """
+    Bounded cache which evicts the least recently used item once it is full.
+    It keeps hit/miss counters so the size could be tuned for big configs.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = odict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > max(self.maxsize, 0):
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+def get_cipher(ekey):
+    """
+    Cipher of the key, cached so it is only built once per key. ekey could be
+    a list of keys to rotate them, the first one encrypts and any of them
+    decrypts. Tokens are the same as encrypted with the first key alone.
+    """
+    keys = tuple(ekey) if isinstance(ekey, (list, tuple)) else (ekey,)
+    return _get_cipher(keys)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_cipher(keys: tuple):
+    # cryptography is only imported once a secret is used
+    from cryptography.fernet import Fernet, MultiFernet
+    return MultiFernet([Fernet(key) for key in keys])
+
+
 def update_recursive(d, u):
     """
     Update dictionary recursively. It traverse any object implements
@@ -42,22 +442,148 @@ def update_recursive(d, u):
     return d
 
 
-def yaml_safe_load(stream):
-    import yaml
+# how list in more than one layer is merged, see merge_layer
+LIST_STRATEGIES = ('replace', 'append', 'unique')
+
+
+class Provenance(dict):
+    """
+    Layer which set the value by dotted path. Only the paths where a layer
+    replaced or added a value are recorded, origin of any other path is the
+    latest layer among its parents. Dict merged from many layers gets the
+    layer which created it.
+    """
+
+    def __init__(self, layers: list):
+        super(Provenance, self).__init__()
+        self.layers = list(layers)
+
+    def origin(self, path):
+        """
+        :param path: Dotted string e.g. "a.b.0" or tuple of keys
+        :return: The layer, None if nothing is loaded
+        """
+        keys = path.split('.') if isinstance(path, str) else [str(k) for k in path]
+        index = self.get('')
+        prefix = ''
+        for k in keys:
+            prefix = '{}.{}'.format(prefix, k) if prefix else k
+            i = self.get(prefix)
+            if i is not None and (index is None or i > index):
+                index = i
+        return None if index is None else self.layers[index]
+
+
+def merge_layer(dst: dict, src: dict, layer: int, provenance: dict = None, list_strategy: str = 'replace'):
+    """
+    Deep merge src into dst in place, iteratively. Only the keys which are
+    in both are visited, any other value of src is taken as it is without
+    walking or copying it, so src should not be used afterwards.
+
+    :param layer: Index of src recorded into provenance for every value it sets
+    :param list_strategy: "replace" the list, "append" the items of src or
+    append the ones which are not in the list yet with "unique"
+    :return: dst
+    """
+    if list_strategy not in LIST_STRATEGIES:
+        raise ValueError('Unknown list strategy: {}'.format(list_strategy))
+    stack = [(dst, src, '')]
+    while stack:
+        d, u, prefix = stack.pop()
+        for k, v in u.items():
+            path = '{}.{}'.format(prefix, k) if prefix else str(k)
+            old = d[k] if k in d else _missing
+            if isinstance(old, dict) and isinstance(v, dict):
+                stack.append((old, v, path))
+                continue
+            if list_strategy != 'replace' and type(old) == list and type(v) == list:
+                start = len(old)
+                old.extend(v if list_strategy == 'append' else [item for item in v if item not in old])
+                if provenance is not None:
+                    provenance.update(('{}.{}'.format(path, i), layer) for i in range(start, len(old)))
+                continue
+            d[k] = v
+            if provenance is not None:
+                provenance[path] = layer
+    return dst
+
+
+def update_shared(d: Mapping, u: dict):
+    """
+    Same as update_recursive on a copy of d, but the nested mappings which u
+    does not update are shared instead of copied, e.g. the frozen default
+    params. Updated nested mappings are copied into dict.
+    """
+    result = dict(d)
+    for k, v in u.items():
+        d2 = result.get(k)
+        if isinstance(v, dict) and isinstance(d2, Mapping):
+            v = update_shared(d2, v)
+        result[k] = v
+    return result
+
+
+def count_leaves(value):
+    """
+    Number of scalar values in nested dict and list
+    """
+    if isinstance(value, dict):
+        return sum(count_leaves(v) for v in dict.values(value))
+    if isinstance(value, (list, tuple)):
+        return sum(count_leaves(v) for v in value)
+    if isinstance(value, LinearRange):
+        return len(value)
+    return 1
+
+
+def yaml_ordered_loader(loader_cls):
     from yaml.resolver import BaseResolver
 
-    def ordered_load(stream, loader_cls):
-        class OrderedLoader(loader_cls):
-            pass
+    class OrderedLoader(loader_cls):
+        pass
+
+    def construct_mapping(loader, node):
+        loader.flatten_mapping(node)
+        return odict(loader.construct_pairs(node))
+
+    OrderedLoader.add_constructor(BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
+    return OrderedLoader
+
+
+@functools.lru_cache(maxsize=None)
+def get_yaml_loader(pure: bool = False):
+    """
+    Ordered safe loader class, built once. libyaml based loader is used whenever it is available
+
+    :param pure: Pure Python loader even if libyaml is available
+    """
+    # yaml is only imported once a YAML text is loaded
+    import yaml
+    if pure or not yaml.__with_libyaml__:
+        return yaml_ordered_loader(yaml.SafeLoader)
+    return yaml_ordered_loader(yaml.CSafeLoader)
+
+
+def yaml_safe_load(stream, loader_cls=None):
+    import yaml
+    return yaml.load(stream, loader_cls or get_yaml_loader())
+
 
-        def construct_mapping(loader, node):
-            loader.flatten_mapping(node)
-            return odict(loader.construct_pairs(node))
+def yaml_safe_load_all(stream, loader_cls=None):
+    """
+    Generator of every document in the YAML stream, only one document is in memory at a time
+    """
+    import yaml
+    return yaml.load_all(stream, loader_cls or get_yaml_loader())
 
-        OrderedLoader.add_constructor(BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
-        return yaml.load(stream, OrderedLoader)
 
-    return ordered_load(stream, yaml.SafeLoader)
+def is_picklable(obj):
+    import pickle
+    try:
+        pickle.loads(pickle.dumps(obj))
+    except Exception:
+        return False
+    return True
 
 
 def filter_value(value):